@@ -0,0 +1,79 @@
+import os
+import numpy as np
+
+
+class ADVICheckpoint:
+    def __init__(self, path, every=10000, resume=True):
+        """
+        Periodic snapshots of an ADVI fit: the approximation's parameters,
+        the optimizer's state (e.g. adagrad_window accumulators) and the loss
+        history, written atomically to an .npz file every `every` iterations.
+
+        attach() the shared state of the compiled ADVI step (see
+        infer.advi_step) and pass the checkpoint itself as a callback. With
+        resume=True an existing snapshot is loaded, and restore() and
+        attach() re-point the approximation and the optimizer at it so the
+        fit continues from checkpoint.start.
+
+        Args:
+        - path: Snapshot filename (.npz)
+        - every: Snapshot interval in iterations (default=10000)
+        - resume: Load an existing snapshot at path (default=True)
+        """
+        self.path = path
+        self.every = every
+        self.tracked = []
+        self.params = []
+        self.start = 0
+        self.prev_hist = np.array([])
+        self.snapshot = None
+        if resume and os.path.exists(path):
+            with np.load(path) as f:
+                self.snapshot = dict(f)
+            self.start = int(self.snapshot['iteration'])
+            self.prev_hist = self.snapshot['hist']
+            print("Resuming ADVI from iteration %d (%s)" % (self.start, path))
+
+    def remaining(self, n):
+        if self.snapshot is not None and self.snapshot.get('converged', False):
+            return 0
+        return max(n - self.start, 0)
+
+    def restore(self, approx):
+        """ Loads snapshotted parameters into approx.params. """
+        self.params = list(approx.params)
+        if self.snapshot is not None:
+            for i, p in enumerate(self.params):
+                p.set_value(self.snapshot['param_%d' % i])
+
+    def attach(self, state):
+        """
+        Records the shared variables the compiled step updates (e.g.
+        adagrad_window accumulators) for snapshots and, when resuming,
+        restores them.
+        """
+        self.tracked = list(state)
+        if self.snapshot is not None and 'state_0' in self.snapshot:
+            for i, var in enumerate(self.tracked):
+                var.set_value(self.snapshot['state_%d' % i])
+
+    def history(self, losses=()):
+        return np.concatenate([self.prev_hist, np.asarray(losses, dtype=float)])
+
+    def save(self, losses, converged=False):
+        arrays = {'iteration': self.start + len(losses), 'hist': self.history(losses),
+                  'converged': converged}
+        for i, p in enumerate(self.params):
+            arrays['param_%d' % i] = p.get_value()
+        for i, var in enumerate(self.tracked):
+            arrays['state_%d' % i] = var.get_value()
+        tmp = self.path + '.tmp.npz'
+        np.savez(tmp, **arrays)
+        os.replace(tmp, self.path)
+
+    def __call__(self, approx, losses, i):
+        """ pm.fit callback: snapshot every `every` iterations. """
+        if not self.params:
+            self.params = list(approx.params)
+        if len(losses) % self.every == 0:
+            self.save(losses)
@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import time
+import shutil
+import multiprocessing
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Theano's module cache is keyed by graph and dtype, so one persistent
+# compiledir serves every architecture. Parallel workers each get their own
+# copy of it, so they neither recompile nor contend for its lock. Theano
+# reads its flags on import, so this module must not import it.
+ROOT = os.environ.get("ROBUSTBNN_COMPILEDIR",
+                      os.path.join(os.path.expanduser("~"), ".theano", "robustbnn"))
+TIMINGS = "timings.json"
+
+
+def main_compiledir(root=None):
+    return os.path.join(root or ROOT, "main")
+
+
+def worker_compiledir(worker, root=None):
+    return os.path.join(root or ROOT, "worker-%d" % worker)
+
+
+def set_compiledir(compiledir):
+    """ Points THEANO_FLAGS at compiledir. Must run before theano is imported. """
+    flags = [f for f in os.environ.get("THEANO_FLAGS", "").split(",")
+             if f and not f.startswith("compiledir=")]
+    os.environ["THEANO_FLAGS"] = ",".join(flags + ["compiledir=" + compiledir])
+
+
+def current_compiledir():
+    """ The compiledir set in THEANO_FLAGS, or None. """
+    for f in os.environ.get("THEANO_FLAGS", "").split(","):
+        if f.startswith("compiledir="):
+            return f[len("compiledir="):]
+    return None
+
+
+def configure(root=None):
+    """
+    Uses the persistent main compiledir for this process. Spawned worker
+    processes re-run the parent's main module, and with it this call; there
+    the compiledir the parent set for the worker (see parallel.sample_chains)
+    is kept.
+    """
+    if "theano" in sys.modules:
+        raise RuntimeError("compilecache.configure must run before theano is imported")
+    if multiprocessing.current_process().name != "MainProcess" and current_compiledir():
+        return
+    set_compiledir(main_compiledir(root))
+
+
+def prewarm(workers, root=None, src=None):
+    """
+    Copies the compiled modules of src (default: the main compiledir) that
+    a worker's compiledir lacks into it, for workers 0..workers-1. Returns
+    the number of modules copied.
+    """
+    src = src or main_compiledir(root)
+    copied = 0
+    for w in range(workers):
+        dst = worker_compiledir(w, root)
+        os.makedirs(dst, exist_ok=True)
+        if not os.path.isdir(src):
+            continue
+        for entry in os.listdir(src):
+            if entry.startswith("lock_dir") or os.path.exists(os.path.join(dst, entry)):
+                continue
+            path = os.path.join(src, entry)
+            if os.path.isdir(path):
+                shutil.copytree(path, os.path.join(dst, entry))
+            else:
+                shutil.copy2(path, os.path.join(dst, entry))
+            copied += 1
+    return copied
+
+
+def arch_key(*parts):
+    """ Key for timings, e.g. arch_key('bnn', 'MNIST', 100, 'float32'). """
+    return "-".join(str(p) for p in parts)
+
+
+class CompileTimer:
+    def __init__(self, key, root=None):
+        """
+        Times the compile-heavy start-up phases of a run (model graph,
+        logp/dlogp, predictive...) and reports them next to the first, cold,
+        run recorded for the same key in <root>/timings.json.
+
+        Args:
+        - key: Architecture/dtype key, see arch_key
+        - root: Compile cache root (default: ROOT)
+        """
+        self.key = key
+        self.path = os.path.join(root or ROOT, TIMINGS)
+        self.times = OrderedDict()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.) + time.time() - start
+
+    def report(self):
+        """ Prints this run's phase times against the cold run and records them. """
+        history = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                history = json.load(f)
+        entry = history.setdefault(self.key, {})
+        cold = entry.setdefault("cold", dict(self.times))
+        entry["last"] = dict(self.times)
+
+        # Only timings: Theano re-optimizes every graph it compiles, so in a
+        # single process the cache changes little and differences between
+        # runs are mostly noise. It pays off in pre-warmed parallel workers.
+        print("Compile times for %s (this run / cold run):" % self.key)
+        for name, secs in self.times.items():
+            print("  %-12s %7.1fs / %7.1fs" % (name, secs, cold.get(name, secs)))
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(history, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+@contextmanager
+def phase(timer, name):
+    """ timer.phase(name), or nothing when timer is None. """
+    if timer is None:
+        yield
+    else:
+        with timer.phase(name):
+            yield
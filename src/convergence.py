@@ -0,0 +1,114 @@
+import os
+import time
+import numpy as np
+
+
+class ConvergenceStop:
+    def __init__(self, every=500, tolerance=1e-3, window=2000, elbo_tolerance=1e-3,
+                 min_iterations=10000):
+        """
+        pm.fit callback that ends the fit (by raising StopIteration) once the
+        approximation has converged, i.e. both
+        - the relative change of the flattened approximation parameters since
+        the previous check is below `tolerance`, and
+        - the mean loss (negative ELBO) over the last `window` iterations
+        differs from the window before it by less than `elbo_tolerance`,
+        relative to its magnitude.
+
+        Args:
+        - every: Check interval in iterations (default=500)
+        - tolerance: Relative parameter-change threshold (default=1e-3)
+        - window: ELBO averaging window in iterations (default=2000)
+        - elbo_tolerance: Relative windowed-ELBO threshold (default=1e-3)
+        - min_iterations: Never stop before this many iterations (default=10000)
+        """
+        self.every = every
+        self.tolerance = tolerance
+        self.window = window
+        self.elbo_tolerance = elbo_tolerance
+        self.min_iterations = min_iterations
+        self.prev = None
+        self.stopped_at = None
+
+    def params_converged(self, approx):
+        current = np.concatenate([p.get_value().ravel() for p in approx.params])
+        prev, self.prev = self.prev, current
+        if prev is None:
+            return False
+        delta = np.linalg.norm(current - prev) / max(np.linalg.norm(prev), 1e-12)
+        return delta < self.tolerance
+
+    def elbo_converged(self, losses):
+        if len(losses) < 2 * self.window:
+            return False
+        last = np.mean(losses[-self.window:])
+        before = np.mean(losses[-2*self.window:-self.window])
+        return abs(last - before) / max(abs(before), 1e-12) < self.elbo_tolerance
+
+    def __call__(self, approx, losses, i):
+        if len(losses) % self.every != 0:
+            return
+        # Evaluate both so the parameter snapshot stays one interval old
+        params_ok = self.params_converged(approx)
+        if params_ok and self.elbo_converged(losses) and len(losses) >= self.min_iterations:
+            self.stopped_at = len(losses)
+            print("ADVI converged after %d iterations" % len(losses))
+            raise StopIteration
+
+
+class ELBOLog:
+    def __init__(self, path, start=0, flush_every=100):
+        """
+        pm.fit callback that appends one CSV row per iteration (iteration,
+        loss, step seconds) to path while the fit runs. Loss is pymc3's
+        negative ELBO. A resumed fit continues the file after dropping the
+        rows past start, which were logged after the snapshot it resumes
+        from.
+
+        Args:
+        - path: CSV filename
+        - start: Iteration offset, e.g. ADVICheckpoint.start when resuming
+        - flush_every: Rows buffered between writes (default=100)
+        """
+        self.start = start
+        self.flush_every = flush_every
+        new = not os.path.exists(path)
+        if not new:
+            truncate_log(path, start)
+        self.f = open(path, 'a')
+        if new:
+            self.f.write('iteration,loss,seconds\n')
+        self.rows = []
+        self.last = time.time()
+
+    def __call__(self, approx, losses, i):
+        now = time.time()
+        self.rows.append('%d,%r,%.6f\n' % (self.start + len(losses), float(losses[-1]),
+                                           now - self.last))
+        self.last = now
+        if len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.f.write(''.join(self.rows))
+        self.f.flush()
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+def truncate_log(path, start):
+    """
+    Keeps the header and the complete rows of an ELBOLog CSV up to
+    iteration start (iterations are logged from 1).
+    """
+    with open(path) as f:
+        lines = f.readlines()
+    rows = [line for line in lines[1:]
+            if line.endswith('\n') and line.count(',') == 2 and int(line.split(',', 1)[0]) <= start]
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.writelines(lines[:1] + rows)
+    os.replace(tmp, path)
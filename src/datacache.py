@@ -0,0 +1,228 @@
+import hashlib
+import json
+import os
+import gzip
+import numpy as np
+import precision
+
+# Every dataset is decoded once from its raw archive into uint8 .npy arrays
+# under CACHE_DIR/<name>/, alongside a manifest of checksums. Loaders memory-map
+# these arrays, so parallel workers share the OS page cache.
+CACHE_DIR = os.environ.get("ROBUSTBNN_CACHE", "cache")
+MANIFEST = "manifest.json"
+
+MNIST_URL = "http://yann.lecun.com/exdb/mnist/"
+MNIST_FILES = {"train_images": "train-images-idx3-ubyte.gz",
+               "train_labels": "train-labels-idx1-ubyte.gz",
+               "test_images": "t10k-images-idx3-ubyte.gz",
+               "test_labels": "t10k-labels-idx1-ubyte.gz"}
+MNIST_DIRS = [".", "data"]
+
+CIFAR10_URL = "https://www.cs.toronto.edu/~kriz/cifar-10-binary.tar.gz"
+CIFAR10_DIR = "cifar-10-batches-bin"
+CIFAR10_TRAIN = ["data_batch_%d.bin" % (i+1) for i in range(5)]
+CIFAR10_TEST = ["test_batch.bin"]
+CIFAR10_RECORD = 32*32*3+1
+
+
+def sha256(path, block=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(block), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _find_mnist(name):
+    for d in MNIST_DIRS:
+        path = os.path.join(d, name)
+        if os.path.exists(path):
+            return path
+    os.makedirs("data", exist_ok=True)
+    path = os.path.join("data", name)
+    print("Downloading %s" % name)
+    import urllib.request  # only needed on a cache miss
+    urllib.request.urlretrieve(MNIST_URL + name, path)
+    return path
+
+
+def _mnist_sources():
+    return {key: _find_mnist(name) for key, name in MNIST_FILES.items()}
+
+
+def _decode_mnist(sources):
+    arrays = {}
+    for key, path in sources.items():
+        with gzip.open(path, "rb") as f:
+            buf = f.read()
+        if key.endswith("images"):
+            arrays[key] = np.frombuffer(buf, np.uint8, offset=16).reshape(-1, 28, 28, 1)
+        else:
+            arrays[key] = np.frombuffer(buf, np.uint8, offset=8)
+    return arrays
+
+
+def _cifar10_sources():
+    if not os.path.exists(CIFAR10_DIR):
+        import urllib.request  # only needed on a cache miss
+        urllib.request.urlretrieve(CIFAR10_URL, "cifar-data.tar.gz")
+        os.popen("tar -xzf cifar-data.tar.gz").read()
+    return {f: os.path.join(CIFAR10_DIR, f) for f in CIFAR10_TRAIN + CIFAR10_TEST}
+
+
+def decode_cifar10_batches(fpaths):
+    """
+    Parses CIFAR-10 binary batches in a single vectorized step. Returns the
+    images as uint8 NHWC and the labels as uint8 class indices.
+    """
+    chunks = []
+    for fpath in fpaths:
+        with open(fpath, "rb") as f:
+            chunks.append(f.read())
+    buf = b"".join(chunks)
+    records = np.frombuffer(buf, dtype=np.uint8).reshape(-1, CIFAR10_RECORD)
+    labels = records[:, 0].copy()
+    images = records[:, 1:].reshape(-1, 3, 32, 32).transpose(0, 2, 3, 1)
+    return np.ascontiguousarray(images), labels
+
+
+def _decode_cifar10(sources):
+    train_images, train_labels = decode_cifar10_batches([sources[f] for f in CIFAR10_TRAIN])
+    test_images, test_labels = decode_cifar10_batches([sources[f] for f in CIFAR10_TEST])
+    return {"train_images": train_images, "train_labels": train_labels,
+            "test_images": test_images, "test_labels": test_labels}
+
+
+DATASETS = {"MNIST": (_mnist_sources, _decode_mnist),
+            "CIFAR10": (_cifar10_sources, _decode_cifar10)}
+
+
+def _stat(path):
+    st = os.stat(path)
+    return [st.st_size, int(st.st_mtime)]
+
+
+def _sources_unchanged(manifest):
+    for entry in manifest["sources"].values():
+        if _stat(entry["path"]) != entry["stat"] and sha256(entry["path"]) != entry["sha256"]:
+            return False
+    return True
+
+
+def _arrays_intact(manifest, cache_dir, verify):
+    for entry in manifest["arrays"].values():
+        path = os.path.join(cache_dir, entry["file"])
+        if not os.path.exists(path):
+            return False
+        if verify and sha256(path) != entry["sha256"]:
+            return False
+    return True
+
+
+def build(name, cache_root=None):
+    """
+    Decodes the raw archives of a dataset and writes the uint8 store and
+    its manifest. Returns the manifest dict.
+    """
+    cache_dir = os.path.join(cache_root or CACHE_DIR, name)
+    os.makedirs(cache_dir, exist_ok=True)
+    find_sources, decode = DATASETS[name]
+    sources = find_sources()
+    arrays = decode(sources)
+
+    manifest = {"name": name, "sources": {}, "arrays": {}}
+    for key, path in sources.items():
+        manifest["sources"][key] = {"path": path, "sha256": sha256(path),
+                                    "stat": _stat(path)}
+    for key, arr in arrays.items():
+        fname = key + ".npy"
+        np.save(os.path.join(cache_dir, fname), arr)
+        manifest["arrays"][key] = {"file": fname, "shape": list(arr.shape),
+                                   "dtype": str(arr.dtype),
+                                   "sha256": sha256(os.path.join(cache_dir, fname))}
+
+    # Write the manifest last so a partial build is never mistaken for a cache
+    tmp = os.path.join(cache_dir, MANIFEST + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, os.path.join(cache_dir, MANIFEST))
+    return manifest
+
+
+def load(name, cache_root=None, verify=False):
+    """
+    Returns a dict of memory-mapped uint8 arrays (train_images, train_labels,
+    test_images, test_labels) for MNIST or CIFAR10, decoding the raw archives
+    only if the cache is missing or stale. Images are NHWC.
+
+    Args:
+    - name: "MNIST" or "CIFAR10"
+    - cache_root: Cache directory (default CACHE_DIR)
+    - verify: Re-hash the cached arrays against the manifest (default=False)
+    """
+    cache_dir = os.path.join(cache_root or CACHE_DIR, name)
+    manifest_path = os.path.join(cache_dir, MANIFEST)
+    manifest = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        # The raw archives may be deleted once the cache has been built
+        if not _arrays_intact(manifest, cache_dir, verify):
+            manifest = None
+        elif (all(os.path.exists(e["path"]) for e in manifest["sources"].values())
+              and not _sources_unchanged(manifest)):
+            manifest = None
+    if manifest is None:
+        manifest = build(name, cache_root)
+    return {key: np.load(os.path.join(cache_dir, entry["file"]), mmap_mode="r")
+            for key, entry in manifest["arrays"].items()}
+
+
+def scaled(data, scale, shift=0., dtype=precision.FLOAT):
+    """
+    Fused cast of a uint8 array to dtype computing data*scale + shift, with
+    a single allocation of the output.
+    """
+    dtype = np.dtype(dtype).type
+    out = np.multiply(data, dtype(scale), dtype=dtype)
+    if shift:
+        out += dtype(shift)
+    return out
+
+
+def one_hot(labels, num_labels=10, dtype=precision.FLOAT):
+    return (np.arange(num_labels) == np.asarray(labels)[:, None]).astype(dtype)
+
+
+class Dataset:
+    """
+    Images held in a single contiguous float buffer of shape (N, H, W, C),
+    with flat, NHWC and NCHW layouts exposed as views of that buffer, so the
+    same memory can back Theano shared variables and Keras inputs.
+
+    Args:
+    - images: NHWC array, copied only if not already contiguous with dtype
+    - labels: Integer class labels or one-hot rows
+    - dtype: Buffer dtype (default precision.FLOAT)
+    """
+    def __init__(self, images, labels, dtype=precision.FLOAT):
+        self.nhwc = np.ascontiguousarray(images, dtype=dtype)
+        self.labels = labels
+
+    @classmethod
+    def from_uint8(cls, images, labels, scale, shift=0., dtype=precision.FLOAT):
+        return cls(scaled(images, scale, shift, dtype), labels, dtype)
+
+    def __len__(self):
+        return len(self.nhwc)
+
+    def __getitem__(self, idx):
+        return Dataset(self.nhwc[idx], self.labels[idx], self.nhwc.dtype)
+
+    @property
+    def flat(self):
+        return self.nhwc.reshape(len(self.nhwc), -1)
+
+    @property
+    def nchw(self):
+        return self.nhwc.transpose(0, 3, 1, 2)
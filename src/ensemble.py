@@ -0,0 +1,244 @@
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from keras.engine.topology import Layer
+from keras.models import Model
+from keras.layers import Input, Flatten, Dense, Activation, Lambda, MaxPooling2D
+
+
+class StackedDense(Layer):
+    """
+    Dense layer holding the weights of every posterior sample, as a
+    (samples, in, out) kernel and a (samples, out) bias, and evaluating all
+    of them with one batched matmul. Inputs are either (batch, in), shared
+    by all samples (the first layer), or (batch, samples, in); outputs are
+    (batch, samples, out). The weights are fixed (not trainable).
+    """
+    def __init__(self, samples, units, use_bias=True, **kwargs):
+        super(StackedDense, self).__init__(**kwargs)
+        self.samples = samples
+        self.units = units
+        self.use_bias = use_bias
+
+    def build(self, input_shape):
+        self.kernel = self.add_weight(name='kernel', trainable=False, initializer='zeros',
+                                      shape=(self.samples, input_shape[-1], self.units))
+        if self.use_bias:
+            self.bias = self.add_weight(name='bias', trainable=False, initializer='zeros',
+                                        shape=(self.samples, self.units))
+        super(StackedDense, self).build(input_shape)
+
+    def call(self, x):
+        if K.ndim(x) == 2:
+            # (batch, in) . (samples, in, out) -> (batch, samples, out)
+            out = tf.tensordot(x, self.kernel, [[1], [1]])
+        else:
+            # One batched matmul over the sample axis
+            out = tf.transpose(tf.matmul(tf.transpose(x, [1, 0, 2]), self.kernel), [1, 0, 2])
+        if self.use_bias:
+            out = out + self.bias
+        return out
+
+    def call_sample(self, x, s):
+        """ (batch, in) -> (batch, out) for posterior sample s alone. """
+        out = K.dot(x, self.kernel[s])
+        if self.use_bias:
+            out = out + self.bias[s]
+        return out
+
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0], self.samples, self.units)
+
+    def get_config(self):
+        config = {'samples': self.samples, 'units': self.units, 'use_bias': self.use_bias}
+        config.update(super(StackedDense, self).get_config())
+        return config
+
+
+class StackedConv2D(Layer):
+    """
+    'same' Conv2D holding the kernels of every posterior sample, as a
+    (samples, kh, kw, in, out) kernel and a (samples, out) bias, with the
+    sample axis folded into channels: outputs are (batch, h, w, samples*out),
+    sample s in channels [s*out, (s+1)*out). With grouped=False the input
+    (batch, h, w, in) is shared by all samples and one conv2d with the
+    kernels concatenated covers them. With grouped=True the input is
+    (batch, h, w, samples*in) and sample s only sees its own group; each
+    group is convolved with its own kernel, one conv2d per sample, so
+    nothing larger than the output is materialized.
+    """
+    def __init__(self, samples, filters, kernel_size, grouped=False, **kwargs):
+        super(StackedConv2D, self).__init__(**kwargs)
+        self.samples = samples
+        self.filters = filters
+        self.kernel_size = kernel_size
+        self.grouped = grouped
+
+    def build(self, input_shape):
+        channels = input_shape[-1] // self.samples if self.grouped else input_shape[-1]
+        self.kernel = self.add_weight(name='kernel', trainable=False, initializer='zeros',
+                                      shape=(self.samples, self.kernel_size, self.kernel_size,
+                                             channels, self.filters))
+        self.bias = self.add_weight(name='bias', trainable=False, initializer='zeros',
+                                    shape=(self.samples, self.filters))
+        super(StackedConv2D, self).build(input_shape)
+
+    def call(self, x):
+        k, f, S = self.kernel_size, self.filters, self.samples
+        channels = K.int_shape(self.kernel)[3]
+        if not self.grouped:
+            # (S, kh, kw, in, out) -> (kh, kw, in, S*out)
+            kernel = tf.reshape(tf.transpose(self.kernel, [1, 2, 3, 0, 4]), [k, k, channels, S * f])
+            out = tf.nn.conv2d(x, kernel, strides=[1, 1, 1, 1], padding='SAME')
+        else:
+            shape = tf.shape(x)
+            n, h, w = shape[0], shape[1], shape[2]
+            # (n, h, w, S*in) -> (S, n, h, w, in), one group per sample
+            groups = tf.transpose(tf.reshape(x, [n, h, w, S, channels]), [3, 0, 1, 2, 4])
+            out = tf.map_fn(lambda group: tf.nn.conv2d(group[0], group[1], strides=[1, 1, 1, 1],
+                                                       padding='SAME'),
+                            (groups, self.kernel), dtype=x.dtype)
+            # (S, n, h, w, out) -> (n, h, w, S*out)
+            out = tf.reshape(tf.transpose(out, [1, 2, 3, 0, 4]), [n, h, w, S * f])
+        return out + tf.reshape(self.bias, [S * f])
+
+    def call_sample(self, x, s):
+        """ (batch, h, w, in) -> (batch, h, w, out) for posterior sample s alone. """
+        out = tf.nn.conv2d(x, self.kernel[s], strides=[1, 1, 1, 1], padding='SAME')
+        return out + self.bias[s]
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[:3] + (self.samples * self.filters,)
+
+    def get_config(self):
+        config = {'samples': self.samples, 'filters': self.filters,
+                  'kernel_size': self.kernel_size, 'grouped': self.grouped}
+        config.update(super(StackedConv2D, self).get_config())
+        return config
+
+
+class SampleFlatten(Layer):
+    """
+    Splits (batch, h, w, samples*c) feature maps, as produced by
+    StackedConv2D, into (batch, samples, h*w*c), each sample flattened in
+    the NHWC order of Keras' Flatten.
+    """
+    def __init__(self, samples, **kwargs):
+        super(SampleFlatten, self).__init__(**kwargs)
+        self.samples = samples
+
+    def call(self, x):
+        _, h, w, c = K.int_shape(x)
+        c //= self.samples
+        x = tf.reshape(x, [-1, h, w, self.samples, c])
+        return tf.reshape(tf.transpose(x, [0, 3, 1, 2, 4]), [-1, self.samples, h * w * c])
+
+    def call_sample(self, x, s):
+        return K.batch_flatten(x)
+
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0], self.samples, input_shape[1] * input_shape[2] * input_shape[3] // self.samples)
+
+    def get_config(self):
+        config = {'samples': self.samples}
+        config.update(super(SampleFlatten, self).get_config())
+        return config
+
+
+def create_ensemble(weights, ISMNIST, proj=None):
+    """
+    Given stacked weights of the dense BNN (see numpy_bnn.stack_weights),
+    constructs a Keras model mapping images to the (batch, samples, labels)
+    logits of every posterior sample, one StackedDense per layer. The
+    architecture is inferred as in glue.create_model.
+
+    Args:
+    - weights: Ordered mapping of layer names to (samples, *shape) arrays
+    - ISMNIST: Input shape switch, MNIST or CIFAR10
+    - proj: projection.Projection applied to the flattened input, as a
+    fixed Dense layer shared by all samples (default=None)
+    """
+    input_shape = (28,28,1) if ISMNIST else (32,32,3)
+    inp = Input(shape=input_shape)
+    x = Flatten()(inp)
+    if proj is not None:
+        projected = Dense(proj.dim, trainable=False, name='projection')
+        x = projected(x)
+        projected.set_weights([proj.components, proj.bias])
+
+    items = list(weights.items())
+    samples = len(items[0][1])
+    i = 0
+    while i < len(items):
+        name, data = items[i]
+        if name.endswith('_u'):
+            # Low-rank input layer: x.U then .V + b
+            layer = StackedDense(samples, data.shape[2], use_bias=False, name=name)
+            x = layer(x)
+            layer.set_weights([data])
+            i += 1
+            name, data = items[i]
+        layer = StackedDense(samples, data.shape[2], name=name)
+        x = layer(x)
+        layer.set_weights([data, items[i+1][1]])
+        i += 2
+        if i < len(items):
+            x = Activation('tanh')(x)
+    return Model(inputs=inp, outputs=x)
+
+
+def create_lenet_ensemble(weights, ISMNIST):
+    """
+    Given stacked weights of the Bayesian LeNet (see
+    numpy_bnn.stack_weights), in the order of glue.create_lenet, constructs
+    a Keras model mapping images to the (batch, samples, labels) logits of
+    every posterior sample. Each layer is one call covering all samples:
+    the convolutions are StackedConv2D with the sample axis in channels,
+    the dense layers StackedDense.
+
+    Args:
+    - weights: Ordered mapping of layer names to (samples, *shape) arrays
+    - ISMNIST: Input shape switch, MNIST or CIFAR10
+    """
+    input_shape = (28,28,1) if ISMNIST else (32,32,3)
+    values = list(weights.values())
+    samples = len(values[0])
+    inp = Input(shape=input_shape)
+    layers = [StackedConv2D(samples, 20, 5),
+              Activation('relu'),
+              MaxPooling2D(pool_size=(2,2), strides=(2,2)),
+              StackedConv2D(samples, 50, 5, grouped=True),
+              Activation('relu'),
+              MaxPooling2D(pool_size=(2,2), strides=(2,2)),
+              SampleFlatten(samples),
+              StackedDense(samples, 500),
+              Activation('relu'),
+              StackedDense(samples, 10)]
+    x = inp
+    for layer in layers:
+        x = layer(x)
+    stacked = [layer for layer in layers if isinstance(layer, (StackedConv2D, StackedDense))]
+    for layer, (kernel, bias) in zip(stacked, zip(values[::2], values[1::2])):
+        layer.set_weights([kernel, bias])
+    return Model(inputs=inp, outputs=x)
+
+
+def average_probs(logits):
+    """ Posterior predictive: softmax of each sample's logits, averaged. """
+    return K.mean(K.softmax(logits), axis=1)
+
+
+def single_sample(logits_model, x, s):
+    """ Logits of posterior sample s alone, on the ensemble's weights. """
+    for layer in logits_model.layers[1:]:
+        x = layer.call_sample(x, s) if hasattr(layer, 'call_sample') else layer.call(x)
+    return x
+
+
+def sample_view(logits_model, s):
+    """
+    Keras model returning the logits of posterior sample s alone. It shares
+    the ensemble's weight tensors and evaluates only its own slice of them.
+    """
+    inp = Input(shape=K.int_shape(logits_model.input)[1:])
+    return Model(inputs=inp, outputs=Lambda(lambda x: single_sample(logits_model, x, s))(inp))
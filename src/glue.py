@@ -1,81 +1,382 @@
-import pickle
+import os
+import json
+from collections import OrderedDict
 import numpy as np
-import tensorflow as tf
-from keras.models import Sequential, Model
-from keras.layers import Dense, Dropout, Activation, Flatten, average
-from keras.layers import Input, InputLayer
-from keras.layers import Conv2D, MaxPooling2D
-from keras.activations import softmax
-import keras
-from theano.misc.pkl_utils import load, dump
+import tracestore
+import projection
+import precision
+import numpy_bnn
+
+# TensorFlow, Keras (and ensemble.py, which builds on them) and Theano are
+# imported by the functions that need them, so loading a trace store and
+# predicting with backend='numpy' imports none of them. Keras layers are
+# built in precision.FLOAT, like the attacks (see keras_backend).
+
+
+def keras_backend():
+    """ Imports Keras, set to precision.FLOAT, and returns its backend. """
+    precision.configure_keras()
+    from keras import backend as K
+    return K
+
+# Files of an exported BNN (see BNN.export)
+EXPORT_GRAPH = "graph.pb"
+EXPORT_MANIFEST = "export.json"
 
 
 class BNN:
     def __init__(self, path=None, ISMNIST=True, num_labels=10, LeNet=False,
-                 num_samples=50, burnin=100):
+                 num_samples=50, burnin=100, swap_weights=False, max_models=None,
+                 backend='keras'):
         """
         Creates a BNN from a set of posterior samples stored as a PyMC3 
         Multitrace object, allowing for predictions and an interface that
         complements Carlini's attack algorithm code. Note that the returned
         Keras models do not perform the softmax activation on the final layer.
+        Every sample is evaluated by one stacked-weight model (see
+        ensemble.py); model_list holds one model per sample.
+        With swap_weights=True a single model template is built instead and
+        the posterior samples are loaded into it one at a time (see
+        WeightSwapper), so memory does not grow with num_samples. self.model
+        then predicts on numpy arrays only and model_list is None.
+
+        Only the chosen sample indices and a handle to the trace are kept up
+        front. Weights are read and models built on first use: self.model
+        and self.logits_model when first accessed, each entry of model_list
+        when indexed (see LazyModelList), so a script using a single sample
+        only loads that one.
+
+        With backend='numpy' the dense BNN is evaluated by
+        numpy_bnn.NumpyBNN instead: self.model is that engine, predict and
+        sample_logits take and return numpy arrays, and neither TensorFlow
+        nor Keras is imported.
         
         Args:
-        - path: String filename for a pickled multitrace object
+        - path: Trace store directory (see tracestore.py), or filename of a
+        legacy pickled multitrace object
         - ISMNIST: Whether the model is classifying MNIST, only relevant if
         the model requested is LeNet (i.e. LeNet=True).
         - num_labels: Number of labels (default=10)
         - LeNet: Boolean for whether we trained a LeNet model (default=False)
         - num_samples: Number of posterior samples to use for BNN (default=50)
         - burnin: Length of burn-in phase, key in MCMC inference (default=100)
+        - swap_weights: Stream samples through one model template instead of
+        building every sample's model (default=False)
+        - max_models: Most per-sample models model_list keeps built, least
+        recently used first to go (default=None, no bound)
+        - backend: 'keras', or 'numpy' for dense BNNs (default='keras')
         """
+        if backend not in ('keras', 'numpy'):
+            raise ValueError("Unknown backend %r" % backend)
+        if backend == 'numpy' and (LeNet or swap_weights):
+            raise ValueError("backend='numpy' only evaluates dense BNNs with stacked weights")
         self.num_channels = 1 if ISMNIST else 3
         self.image_size = 28 if ISMNIST else 32
         self.num_labels = num_labels
+        self.ISMNIST = ISMNIST
+        self.LeNet = LeNet
+        self.path = path
+        self.swap_weights = swap_weights
+        self.backend = backend
 
-        with open(path, 'rb') as f:
-            # Randomly choose posterior samples after burnin phase
-            # and create a Keras model for each
-            #trace = pickle.load(f)
-            trace = load(f)['trace']
-            # print(trace)
-            ids = np.random.choice(range(burnin, len(trace)), 
-                                          num_samples, replace=False)
-            # ids = np.ones(num_samples)
-            models = ([create_lenet(trace.point(i), ISMNIST) for i in ids]
-                     if LeNet else [create_model(trace.point(i), ISMNIST) 
-                                                            for i in ids])
-        
-        # print(trace.point(1))
-        # print(trace.point(199))
-
-        def average_preds(models, data):
-            """
-            Takes in a list of posterior samples and data as a Numpy array
-            and returns a Keras model instance that averages the input models'
-            predictions.
-
-            Args:
-            - models: A list of Keras models
-            - data: Observations as a Numpy array
-            """
-            out = [model(data) for model in models]
-            preds = [Activation('softmax')(o) for o in out]
-            avg = average(preds)
-            avg_model = Model(inputs=data, outputs=avg)
-            return avg_model
-
-        # Save model returned by average_preds function as model
-        inp = Input(shape=(self.image_size, self.image_size, self.num_channels,))
-        model = average_preds(models, inp)
-        self.model = model
-        self.model_list = models
+        # Randomly choose posterior samples after burnin phase
+        self.trace = load_trace(path)
+        self.ids = np.sort(np.random.choice(range(burnin, len(self.trace)),
+                                            num_samples, replace=False))
+        # The input projection the dense BNN was trained with, if any
+        self.proj = None if LeNet else projection.load_for(path)
+        self._model = None
+        self._logits_model = None
+        keras_models = backend == 'keras' and not swap_weights
+        self.model_list = LazyModelList(self.sample_model, len(self.ids), max_models) if keras_models else None
+
+    @property
+    def logits_model(self):
+        """
+        The stacked-weight model of all samples: the LeNet with the sample
+        axis folded into conv channels, or the dense BNN. None when
+        swap_weights is set or the backend is numpy.
+        """
+        if self._logits_model is None and not self.swap_weights and self.backend == 'keras':
+            keras_backend()
+            import ensemble
+            weights = numpy_bnn.stack_weights(self.trace, self.ids)
+            if self.LeNet:
+                self._logits_model = ensemble.create_lenet_ensemble(weights, self.ISMNIST)
+            else:
+                self._logits_model = ensemble.create_ensemble(weights, self.ISMNIST, self.proj)
+        return self._logits_model
+
+    @property
+    def model(self):
+        """ Averaged posterior predictive, built on first use. """
+        if self._model is None:
+            if self.backend == 'numpy':
+                self._model = numpy_bnn.NumpyBNN(numpy_bnn.stack_weights(self.trace, self.ids), self.proj)
+            elif self.swap_weights:
+                self._model = WeightSwapper(self.trace, self.ids, self.ISMNIST, self.LeNet, self.proj)
+            else:
+                import ensemble
+                from keras.models import Model
+                from keras.layers import Input, Lambda
+                inp = Input(shape=(self.image_size, self.image_size, self.num_channels,))
+                logits = self.logits_model(inp)
+                self._model = Model(inputs=inp, outputs=Lambda(ensemble.average_probs)(logits))
+        return self._model
+
+    def sample_model(self, k):
+        """
+        Keras model of the k-th chosen posterior sample: a view of the
+        stacked model if that is already built, otherwise a standalone model
+        reading only this sample's weights.
+        """
+        if self._logits_model is not None:
+            import ensemble
+            return ensemble.sample_view(self._logits_model, k)
+        weights = self.trace.point(self.ids[k])
+        if self.LeNet:
+            return create_lenet(weights, self.ISMNIST)
+        return create_model(weights, self.ISMNIST, self.proj)
+
+    def sample_logits(self, data):
+        """ (batch, samples, labels) logits of every posterior sample, in one pass. """
+        if self.swap_weights:
+            raise ValueError("Per-sample logits are not available with swap_weights=True")
+        if self.backend == 'numpy':
+            return self.model.sample_logits(data)
+        return self.logits_model(data)
     
     def predict(self, data):
-        """ Prediction function that wraps average_preds for convenience. """
+        """
+        Posterior predictive probabilities of data, averaged over the chosen
+        samples: a tensor for the Keras backend, an array for numpy.
+        """
+        data = precision.check('BNN.predict', data)
+        if self.backend == 'numpy':
+            return self.model.predict_proba(data)
+        if self.swap_weights:
+            return self.model.predict(data)
         return self.model(data)
 
+    def export(self, path):
+        """
+        Writes the stacked-weight model as a frozen TensorFlow graph, with
+        the chosen posterior samples baked in as constants and outputs for
+        both the per-sample logits and the averaged probabilities. Load it
+        with BNN.from_export, which needs neither the trace nor Theano.
+
+        Args:
+        - path: Export directory, created if needed
+        """
+        if self.swap_weights or self.backend != 'keras':
+            raise ValueError("Only the stacked-weight Keras model can be exported")
+        import tensorflow as tf
+        import ensemble
+        logits_model = self.logits_model
+        sess = keras_backend().get_session()
+        with sess.graph.as_default():
+            logits = tf.identity(logits_model.output, name='bnn_logits')
+            probs = tf.identity(ensemble.average_probs(logits), name='bnn_probs')
+            frozen = tf.graph_util.convert_variables_to_constants(
+                sess, sess.graph.as_graph_def(), [logits.op.name, probs.op.name])
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, EXPORT_GRAPH), 'wb') as f:
+            f.write(frozen.SerializeToString())
+        manifest = {'input': logits_model.input.name, 'logits': logits.name, 'probs': probs.name,
+                    'ISMNIST': self.ISMNIST, 'LeNet': self.LeNet, 'num_labels': self.num_labels,
+                    'ids': [int(i) for i in self.ids], 'source': self.path}
+        with open(os.path.join(path, EXPORT_MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=1)
+
+    @classmethod
+    def from_export(cls, path):
+        """ Loads a BNN written by BNN.export (see ExportedBNN). """
+        return ExportedBNN(path)
+
+
+class ExportedBNN:
+    def __init__(self, path):
+        """
+        A BNN loaded from a frozen graph written by BNN.export, with the
+        interface of BNN (model, model_list, sample_logits, predict). The
+        graph is imported onto each input tensor it is applied to, once per
+        tensor, so attacks can differentiate through it.
+
+        Args:
+        - path: Export directory
+        """
+        with open(os.path.join(path, EXPORT_MANIFEST)) as f:
+            self.manifest = json.load(f)
+        import tensorflow as tf
+        self.graph_def = tf.GraphDef()
+        with open(os.path.join(path, EXPORT_GRAPH), 'rb') as f:
+            self.graph_def.ParseFromString(f.read())
+        self.ISMNIST = self.manifest['ISMNIST']
+        self.LeNet = self.manifest['LeNet']
+        self.num_channels = 1 if self.ISMNIST else 3
+        self.image_size = 28 if self.ISMNIST else 32
+        self.num_labels = self.manifest['num_labels']
+        self.ids = np.array(self.manifest['ids'])
+        self.model = ExportedModel(self)
+        # Imported (logits, probs) per input tensor
+        self.applied = {}
+        self.model_list = LazyModelList(lambda k: (lambda data: self.sample_logits(data)[:, k]),
+                                        len(self.ids))
+
+    def apply(self, data):
+        """
+        The (logits, probs) of the graph imported onto data. Importing copies
+        the weight constants into the session's graph, so tensors reuse
+        their first import.
+        """
+        import tensorflow as tf
+        if isinstance(data, tf.Tensor) and data in self.applied:
+            return self.applied[data]
+        outputs = tf.import_graph_def(self.graph_def, input_map={self.manifest['input']: data},
+                                      return_elements=[self.manifest['logits'], self.manifest['probs']],
+                                      name='exported_bnn')
+        if isinstance(data, tf.Tensor):
+            self.applied[data] = outputs
+        return outputs
+
+    def sample_logits(self, data):
+        """ (batch, samples, labels) logits of every posterior sample, in one pass. """
+        return self.apply(data)[0]
+
+    def predict(self, data):
+        """ Averaged posterior predictive probabilities of a data tensor, as BNN.predict. """
+        return self.model(precision.check('BNN.predict', data))
+
+
+class ExportedModel:
+    def __init__(self, bnn):
+        """ Averaged probabilities of an ExportedBNN, like BNN.model. """
+        self.bnn = bnn
+        self.feed = None
+
+    def __call__(self, data):
+        return self.bnn.apply(data)[1]
+
+    def predict(self, x, batch_size=256):
+        """ Averaged probabilities of a numpy batch, computed in the Keras session. """
+        import tensorflow as tf
+        K = keras_backend()
+        if self.feed is None:
+            shape = (None, self.bnn.image_size, self.bnn.image_size, self.bnn.num_channels)
+            inp = tf.placeholder(tf.as_dtype(precision.FLOAT), shape)
+            self.feed = (inp, self(inp))
+        inp, probs = self.feed
+        sess = K.get_session()
+        return np.concatenate([sess.run(probs, {inp: x[i:i+batch_size]})
+                               for i in range(0, len(x), batch_size)])
+
+
+class LazyModelList:
+    def __init__(self, build, length, max_models=None):
+        """
+        Read-only sequence of per-sample models, each built by build(k) when
+        first indexed. At most max_models are kept, least recently used
+        ones are dropped and rebuilt if needed again.
+
+        Args:
+        - build: Function from a sample position to its Keras model
+        - length: Number of samples
+        - max_models: Bound on the models kept built (default=None, no bound)
+        """
+        self.build = build
+        self.length = length
+        self.max_models = max_models
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[i] for i in range(*k.indices(self.length))]
+        k = int(k)
+        if k < 0:
+            k += self.length
+        if not 0 <= k < self.length:
+            raise IndexError("sample %d out of range" % k)
+        if k in self.cache:
+            self.cache.move_to_end(k)
+        else:
+            self.cache[k] = self.build(k)
+            if self.max_models is not None and len(self.cache) > self.max_models:
+                self.cache.popitem(last=False)
+        return self.cache[k]
+
+    def __iter__(self):
+        for k in range(self.length):
+            yield self[k]
+
+
+class WeightSwapper:
+    def __init__(self, trace, ids, ISMNIST, LeNet=False, proj=None):
+        """
+        Posterior predictive of a BNN evaluated on one Keras model template,
+        into which each posterior sample's weights are loaded in turn.
+        Predictions are accumulated as running averages, so only one model
+        and one sample's weights are held at a time.
 
-def create_model(weights, ISMNIST):
+        Args:
+        - trace: Trace store or Multitrace of posterior samples
+        - ids: Indices of the posterior samples to use
+        - ISMNIST: Input shape switch, MNIST or CIFAR10
+        - LeNet: Whether the samples are LeNet weights (default=False)
+        - proj: projection.Projection of a dense BNN's input (default=None)
+        """
+        self.trace = trace
+        self.ids = np.sort(ids)
+        self.proj = proj
+        first = trace.point(self.ids[0])
+        self.template = create_lenet(first, ISMNIST) if LeNet else create_model(first, ISMNIST, proj)
+
+    def load(self, i):
+        """ Loads posterior sample i into the template. """
+        values = list(self.trace.point(i).values())
+        if self.proj is not None:
+            values = [self.proj.components, self.proj.bias] + values
+        self.template.set_weights(values)
+
+    def evaluate(self, data, batch_size=256):
+        """
+        Averaged probabilities and the predictive uncertainty
+        E[sum p^2] - sum E[p]^2 (as new_attack.differentiable_u_multiple)
+        of every input, in one pass over the posterior samples.
+        """
+        mean = 0.
+        sq = 0.
+        for k, i in enumerate(self.ids):
+            self.load(i)
+            logits = self.template.predict(data, batch_size=batch_size)
+            p = np.exp(logits - logits.max(axis=1, keepdims=True))
+            p /= p.sum(axis=1, keepdims=True)
+            # Running means over the samples seen so far
+            mean += (p - mean) / (k + 1)
+            sq += (np.sum(p**2, axis=1) - sq) / (k + 1)
+        return mean, sq - np.sum(mean**2, axis=1)
+
+    def predict(self, data, batch_size=256):
+        """ Averaged probabilities, like the stacked model's predict. """
+        return self.evaluate(data, batch_size)[0]
+
+
+def load_trace(path):
+    """
+    Returns a trace store for path, or unpickles a legacy Multitrace zip.
+    Only the samples read through point() are loaded from a trace store.
+    """
+    if tracestore.is_store(path):
+        return tracestore.load(path)
+    # Only legacy pickles need Theano
+    from theano.misc.pkl_utils import load
+    with open(path, 'rb') as f:
+        return load(f)['trace']
+
+
+def create_model(weights, ISMNIST, proj=None):
     """
     Given a set of weights, constructs a simple BNN with only dense layers.
     Returns a Keras model.
@@ -83,18 +384,34 @@ def create_model(weights, ISMNIST):
     Args:
     - weights: A dict with layer names as keys and Numpy arrays of float 
     weights as values.
+    - proj: projection.Projection applied to the flattened input, as a
+    fixed Dense layer so gradients still reach the pixels (default=None)
     """
+    keras_backend()
+    from keras.models import Sequential
+    from keras.layers import Dense, Activation, Flatten
     model = Sequential()
-    num_layers = len(weights)
     input_shape = (28,28,1) if ISMNIST else (32,32,3)
     layers = [Flatten(input_shape=input_shape)]
+    values = list(weights.values())
+    if proj is not None:
+        layers.append(Dense(proj.dim, trainable=False, name='projection'))
+        values = [proj.components, proj.bias] + values
     
     # We will infer NN architecture from the shapes of the weight arrays.
-    for i, (name, data) in enumerate(list(weights.items())[0::2]):
-        
-        # Set input_dims only for the first layer
+    items = list(weights.items())
+    i = 0
+    while i < len(items):
+        name, data = items[i]
+        if name.endswith('_u'):
+            # Low-rank input layer (model.create_NN with rank=r): x.U then
+            # .V + b, so U.V is never formed
+            layers.append(Dense(data.shape[1], use_bias=False, name=name))
+            i += 1
+            name, data = items[i]
         layers.append(Dense(data.shape[1], name=name))
-        if i != num_layers//2 - 1:
+        i += 2
+        if i < len(items):
             layers.append(Activation('tanh'))
 
     # Construct model architecture
@@ -105,11 +422,14 @@ def create_model(weights, ISMNIST):
     # for w in list(weights.values()):
         # print(w.shape)
 
-    model.set_weights(list(weights.values()))
+    model.set_weights(values)
     return model
 
 
 def create_lenet(weights, ISMNIST):
+    keras_backend()
+    from keras.models import Sequential
+    from keras.layers import Dense, Activation, Flatten, Conv2D, MaxPooling2D
     model = Sequential()
     input_shape = (28, 28, 1) if ISMNIST else (32,32,3)
     layers = [Conv2D(20, 5, padding='same', input_shape=input_shape),
@@ -137,13 +457,12 @@ def check_model_dims(path):
     a posterior sample. Prints out the shapes of one posterior.
 
     Args:
-    - path: String filename, assumed to be a pickled Multitrace object
+    - path: Trace store directory or legacy pickled Multitrace filename
     """
-    with open(path, 'rb') as f:
-        trace = pickle.load(f)['trace']
-        one_iter = trace.point(40)
-        for arr in list(one_iter.values()):
-            print(arr.shape)
+    trace = load_trace(path)
+    one_iter = trace.point(40)
+    for arr in list(one_iter.values()):
+        print(arr.shape)
 
 if __name__ == '__main__':
     path = 'advi-MNIST.pkl'
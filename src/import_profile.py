@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Import-time profile of this repo's modules, each imported in a fresh
+interpreter under `python -X importtime`.
+
+Usage:
+import_profile.py [--top N] [--trace DIR] [module ...]
+
+For every module (default: glue, loaddata, numpy_bnn, new_attack) prints
+the total import time, the slowest top-level packages it pulled in, and
+which heavy dependencies (Theano, pymc3, TensorFlow, Keras, matplotlib,
+sklearn) were loaded. With --trace, also runs the NumPy prediction path,
+glue.BNN(DIR, backend='numpy').predict, and fails if it imports Theano,
+pymc3 or matplotlib.
+"""
+import argparse
+import json
+import subprocess
+import sys
+from collections import defaultdict
+
+MODULES = ("glue", "loaddata", "numpy_bnn", "new_attack")
+HEAVY = ("theano", "pymc3", "tensorflow", "keras", "matplotlib", "sklearn")
+# Must never be imported on the NumPy prediction path
+FORBIDDEN = ("theano", "pymc3", "matplotlib")
+
+NUMPY_PATH = """
+import sys, json, numpy as np
+import glue
+bnn = glue.BNN(%r, backend='numpy', num_samples=%d, burnin=%d)
+x = np.zeros((8, bnn.image_size, bnn.image_size, bnn.num_channels), dtype=glue.precision.FLOAT)
+bnn.predict(x)
+print(json.dumps(sorted(set(m.split('.')[0] for m in sys.modules))))
+"""
+
+
+def profile(module):
+    """
+    Imports module under -X importtime. Returns its cumulative import time
+    in seconds and, for each top-level package it pulled in, the time of
+    that package's outermost import.
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    entries = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Names are indented two spaces per nesting level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((depth, int(cumulative) / 1e6, name.strip()))
+    # Entries are in post-order: the module's imports directly precede it,
+    # back to the previous top-level import (interpreter startup)
+    end = max(i for i, (depth, _, name) in enumerate(entries) if depth == 0 and name == module)
+    start = end
+    while start > 0 and entries[start - 1][0] > 0:
+        start -= 1
+    packages = defaultdict(float)
+    for _, seconds, name in entries[start:end]:
+        package = name.split(".")[0]
+        packages[package] = max(packages[package], seconds)
+    return entries[end][1], packages
+
+
+def numpy_path_modules(trace, num_samples, burnin):
+    """ Top-level modules loaded after a NumPy-path BNN prediction. """
+    proc = subprocess.run([sys.executable, "-c", NUMPY_PATH % (trace, num_samples, burnin)],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile module import times")
+    parser.add_argument("modules", nargs="*", default=list(MODULES))
+    parser.add_argument("--top", type=int, default=5, help="Slowest packages shown per module")
+    parser.add_argument("--trace", default=None, help="Trace store to run the NumPy prediction path on")
+    parser.add_argument("--num-samples", type=int, default=10)
+    parser.add_argument("--burnin", type=int, default=0)
+    opts = parser.parse_args()
+
+    for module in opts.modules:
+        try:
+            total, packages = profile(module)
+        except RuntimeError as e:
+            print("%s: FAILED (%s)" % (module, e))
+            continue
+        heavy = [p for p in HEAVY if p in packages]
+        print("%s: %.2fs, heavy: %s" % (module, total, ", ".join(heavy) or "none"))
+        for name, seconds in sorted(packages.items(), key=lambda kv: -kv[1])[:opts.top]:
+            print("  %-20s %.3fs" % (name, seconds))
+
+    if opts.trace is not None:
+        loaded = numpy_path_modules(opts.trace, opts.num_samples, opts.burnin)
+        bad = [p for p in FORBIDDEN if p in loaded]
+        print("NumPy BNN.predict path, heavy: %s" % (", ".join(p for p in HEAVY if p in loaded) or "none"))
+        if bad:
+            print("FAILED: imported %s" % ", ".join(bad))
+            raise SystemExit(1)
@@ -3,9 +3,15 @@ import theano
 import pickle
 import os
 import numpy as np
+import theano.tensor as T
 floatX = theano.config.floatX
-from scipy.stats import mode
 from theano.misc.pkl_utils import load, dump
+import parallel
+import tracestore
+import streamtrace
+import sgmcmc
+import compilecache
+import precision
 
 '''
 def save_trace(trace, filename):
@@ -21,87 +27,262 @@ def load_trace(filename):
 	return trace
 '''
 
-# Save trace and load that works with gpu/cpu conversion.
-# TODO: When trace is loaded, it results in very bad accuracy. Why?
+# Traces are saved as trace stores (see tracestore.py): one array per
+# variable plus a JSON manifest, loadable without Theano or a GPU.
 def save_trace(trace, filename):
-	with open(filename, 'wb') as buff:
-		dump({'trace': trace}, buff)
+	tracestore.save(trace, filename)
 	print("Saving trace done.")
 
 def load_trace(filename):
-	trace = []
-	with open(filename, 'rb') as buff:
-		#trace = load(buff)['trace'] # this works on gpu but why not on cpu...
-		npzfile = np.load(buff)
-		for t in npzfile:
-			trace.append(np.asarray(t))
-	print(type(trace))
+	if tracestore.is_store(filename):
+		trace = tracestore.load(filename)
+	else: # Legacy theano pkl_utils zip
+		with open(filename, 'rb') as buff:
+			trace = load(buff)['trace']
 	print("Loading trace done.")
 	return trace
 
-def train_model(inference_alg, model, num_posterior, nn_input, nn_output, X_train, Y_train, X_test, Y_test):
+def train_model(inference_alg, model, num_posterior, nn_input, nn_output, X_train, Y_train, X_test, Y_test,
+				minibatches=None, chains=1, n_iter=150000, checkpoint=None, early_stopping=None,
+				elbo_log=None, stream_dir=None, burn=0, thin=1, sgmcmc_kwargs=None, timer=None):
 	#inference_alg.fit(n, method, data)
 	#return posterior_samples
 
 	if inference_alg is 'advi':
-		minibatch_x = pm.Minibatch(X_train.astype(floatX), batch_size=500)
-		minibatch_y = pm.Minibatch(Y_train.astype(floatX), batch_size=500)
+		callbacks = []
+		if minibatches is not None:
+			# Batches are read from the uint8 store and converted one at a time
+			callbacks.append(minibatches)
+		minibatch_x, minibatch_y = minibatch_tensors(model, X_train, Y_train, minibatches)
+		# TODO: NaN Problem when increasing hidden nodes.
+		# https://discourse.pymc.io/t/nan-occurred-in-optimization-with-advi/1089
+		# Compiled once per model, reset to a fresh fit here
+		inference, step_func, state = advi_step(model, nn_input, nn_output, minibatch_x, minibatch_y)
+		approx = inference.approx
+		n = n_iter
+		if checkpoint is not None:
+			# Continue from the latest snapshot, if any
+			checkpoint.restore(approx)
+			checkpoint.attach(state)
+			n = checkpoint.remaining(n_iter)
+			callbacks.append(checkpoint)
+		if elbo_log is not None:
+			callbacks.append(elbo_log)
+		if early_stopping is not None:
+			# Last, since it ends the fit by raising StopIteration
+			callbacks.append(early_stopping)
+		try:
+			losses = run_advi(approx, step_func, n, callbacks)
+		finally:
+			if elbo_log is not None:
+				elbo_log.close()
+		if checkpoint is not None and n > 0:
+			converged = early_stopping is not None and early_stopping.stopped_at is not None
+			checkpoint.save(losses, converged=converged)
 		with model:
-			# TODO: NaN Problem when increasing hidden nodes.
-			# https://discourse.pymc.io/t/nan-occurred-in-optimization-with-advi/1089
-			inference = pm.ADVI()
-			approx = pm.fit(n=150000, method=inference,
-								more_replacements={nn_input:minibatch_x, nn_output:minibatch_y})
 			trace = approx.sample(draws=num_posterior)
 		
 		print(pm.summary(trace))
 
-		nn_input.set_value(X_test)
-		nn_output.set_value(Y_test)
-
-		with model:
-			ppc_test = pm.sample_ppc(trace, samples=num_posterior)
-			pred_test = mode(ppc_test['out'], axis=0).mode[0, :]
+		with compilecache.phase(timer, 'predictive'):
+			predictive = compile_predictive(model, nn_input, approx=approx, num_posterior=num_posterior)
+		pred_test = predict_proba(predictive, X_test).argmax(axis=1)
 
 	elif inference_alg is 'nuts':
-		with model:
-			#sample_kwargs = {'cores': 1, 'init': 'advi+adapt_diag', 
-			#					'draws': num_posterior, 'max_treedepth': 15, 'target_accept': 0.9}
-			sample_kwargs = {'cores': 1, 'init': 'auto'}
-			trace = pm.sample(**sample_kwargs)
+		if chains > 1:
+			# One process per chain, merged into a single MultiTrace (streamed
+			# to per-chain trace stores by the workers if stream_dir is set)
+			trace, report = parallel.sample_chains(model, chains, step='nuts', timer=timer, init='auto',
+													stream_dir=stream_dir, burn=burn, thin=thin)
+		elif stream_dir is not None:
+			# Draws are written to a trace store as they are sampled
+			step, start = mcmc_step(model, 'nuts')
+			trace = streamtrace.sample(model, stream_dir, chains=chains, burn=burn, thin=thin,
+										step=step, start=start)
+		else:
+			with model:
+				#sample_kwargs = {'cores': 1, 'init': 'advi+adapt_diag', 
+				#					'draws': num_posterior, 'max_treedepth': 15, 'target_accept': 0.9}
+				step, start = mcmc_step(model, 'nuts')
+				sample_kwargs = {'cores': 1, 'step': step, 'start': start}
+				trace = pm.sample(**sample_kwargs)
 		
 		print(pm.summary(trace))
 
-		nn_input.set_value(X_test)
-		nn_output.set_value(Y_test)
-
-		with model:
-			ppc_test = pm.sample_ppc(trace, samples=num_posterior)
-			pred_test = mode(ppc_test['out'], axis=0).mode[0, :]
+		with compilecache.phase(timer, 'predictive'):
+			predictive = compile_predictive(model, nn_input, trace=trace, num_posterior=num_posterior)
+		pred_test = predict_proba(predictive, X_test).argmax(axis=1)
 	
 	elif inference_alg is 'hmc':
-		with model:
-			step = pm.HamiltonianMC(step_scale=0.15)
-			sample_kwargs = {'step': step, 'draws': num_posterior}
-			trace = pm.sample(**sample_kwargs)
+		if chains > 1:
+			trace, report = parallel.sample_chains(model, chains, step='hmc', timer=timer,
+													draws=num_posterior, stream_dir=stream_dir,
+													burn=burn, thin=thin)
+		elif stream_dir is not None:
+			trace = streamtrace.sample(model, stream_dir, chains=chains, burn=burn, thin=thin,
+										draws=num_posterior, step=mcmc_step(model, 'hmc')[0])
+		else:
+			with model:
+				step, _ = mcmc_step(model, 'hmc')
+				sample_kwargs = {'step': step, 'draws': num_posterior}
+				trace = pm.sample(**sample_kwargs)
 		
 		pm.summary(trace)
 
-		nn_input.set_value(X_test)
-		nn_output.set_value(Y_test)
-
-		with model:
-			ppc_test = pm.sample_ppc(trace, samples=num_posterior)
-			pred_test = mode(ppc_test['out'], axis=0).mode[0, :]
+		with compilecache.phase(timer, 'predictive'):
+			predictive = compile_predictive(model, nn_input, trace=trace, num_posterior=num_posterior)
+		pred_test = predict_proba(predictive, X_test).argmax(axis=1)
 	
+	elif inference_alg in ('sgld', 'sghmc'):
+		# Minibatch SG-MCMC on the same model and minibatches as ADVI
+		callback = minibatches.advance if minibatches is not None else None
+		minibatch_x, minibatch_y = minibatch_tensors(model, X_train, Y_train, minibatches)
+		backend = None
+		if stream_dir is not None:
+			backend = streamtrace.StreamingTrace(streamtrace.chain_path(stream_dir, 0), model=model)
+		trace = sgmcmc.sample(model, nn_input, nn_output, minibatch_x, minibatch_y,
+								method=inference_alg, draws=num_posterior, trace=backend,
+								callback=callback, **(sgmcmc_kwargs or {}))
+
+		print(pm.summary(trace))
+
+		with compilecache.phase(timer, 'predictive'):
+			predictive = compile_predictive(model, nn_input, trace=trace, num_posterior=num_posterior)
+		pred_test = predict_proba(predictive, X_test).argmax(axis=1)
+
 	return pred_test, trace
 
-def eval_pickled_model(model, num_posterior, nn_input, nn_output, X_test, Y_test, trace=None):
-	nn_input.set_value(X_test)
-	nn_output.set_value(Y_test)
+# Compiled step functions and step methods are cached on the model (like
+# compile_predictive's functions), so the points of a prior sweep, which
+# only change the shared prior hyperparameters (see model.set_prior), reuse
+# them instead of compiling again. Their state is reset for every fit.
+
+def minibatch_tensors(model, X_train, Y_train, minibatches=None):
+	"""
+	Minibatch tensors substituted for the model's inputs: a MinibatchStream's
+	x and y, or pm.Minibatch views of the training set created once per model.
+	"""
+	if minibatches is not None:
+		return minibatches.x, minibatches.y
+	if '_minibatch' not in model.__dict__:
+		model.__dict__['_minibatch'] = (pm.Minibatch(X_train.astype(floatX, copy=False), batch_size=500),
+										pm.Minibatch(Y_train.astype(floatX), batch_size=500))
+	return model.__dict__['_minibatch']
+
+def advi_step(model, nn_input, nn_output, minibatch_x, minibatch_y):
+	"""
+	ADVI on model with its step function (one adagrad_window update on a
+	minibatch, returning the loss) compiled on first use. Returns the
+	inference, the step function and the shared variables it updates (the
+	approximation's parameters and the optimizer's accumulators), after
+	resetting those to their initial values.
+	"""
+	cache = model.__dict__.setdefault('_advi_step', {})
+	key = (nn_input, minibatch_x)
+	if key not in cache:
+		with model:
+			inference = pm.ADVI()
+		state = []
+		def optimizer(loss_or_grads, params):
+			updates = pm.adagrad_window(loss_or_grads, params)
+			state.extend(updates.keys())
+			return updates
+		step_func = inference.objective.step_function(
+			score=True, obj_optimizer=optimizer,
+			more_replacements={nn_input: minibatch_x, nn_output: minibatch_y})
+		cache[key] = (inference, step_func, state, [v.get_value() for v in state])
+	inference, step_func, state, initial = cache[key]
+	for var, value in zip(state, initial):
+		var.set_value(value)
+	return inference, step_func, state
+
+def run_advi(approx, step_func, n, callbacks=()):
+	"""
+	Runs up to n ADVI steps, calling every pm.fit callback(approx, losses, i)
+	after each, until one raises StopIteration. Returns the losses.
+	"""
+	losses = np.empty(n)
+	done = 0
+	try:
+		for i in range(n):
+			losses[i] = step_func()
+			done = i + 1
+			if not np.isfinite(losses[i]):
+				raise FloatingPointError('NaN occurred in optimization.')
+			for callback in callbacks:
+				callback(approx, losses[:done], done)
+	except StopIteration:
+		pass
+	return losses[:done]
+
+def mcmc_step(model, inference_alg):
+	"""
+	The NUTS or HMC step method of model, built with its compiled logp/dlogp
+	on first use, and the start points to pass to pm.sample: for NUTS the
+	jittered ones of pm.init_nuts (as pm.sample's init='auto'), else None.
+	Its tuning is reset before it is returned again.
+	"""
+	cache = model.__dict__.setdefault('_mcmc_step', {})
+	if inference_alg not in cache:
+		with model:
+			if inference_alg == 'nuts':
+				start, step = pm.init_nuts(init='auto', model=model)
+				cache[inference_alg] = (step, start)
+			else:
+				cache[inference_alg] = (pm.HamiltonianMC(step_scale=0.15), None)
+	elif hasattr(cache[inference_alg][0], 'reset_tuning'):
+		cache[inference_alg][0].reset_tuning()
+	return cache[inference_alg]
 
-	with model:
-		ppc_test = pm.sample_ppc(trace, samples=num_posterior)
-		pred_test = mode(ppc_test['out'], axis=0).mode[0, :]
+def eval_pickled_model(model, num_posterior, nn_input, nn_output, X_test, Y_test, trace=None):
+	predictive = compile_predictive(model, nn_input, trace=trace, num_posterior=num_posterior)
+	pred_test = predict_proba(predictive, X_test).argmax(axis=1)
 	
-	return pred_test
\ No newline at end of file
+	return pred_test
+
+def compile_predictive(model, nn_input, trace=None, approx=None, num_posterior=100):
+	"""
+	Compiles a Theano function mapping a batch of inputs to the class
+	probabilities averaged over posterior samples, evaluating every sample
+	in one call. Samples are drawn inside the graph from an ADVI
+	approximation (as with approx.sample_node), or taken as evenly spaced
+	draws of a trace and evaluated with scan.
+	"""
+	x = nn_input.type('x')
+	p = model['out'].distribution.p
+
+	if approx is not None:
+		# Reads the approximation's shared parameters, so it stays valid
+		# for later fits of the same approximation (see advi_step)
+		cache = model.__dict__.setdefault('_approx_predictive', {})
+		key = (nn_input, approx, num_posterior)
+		if key not in cache:
+			probs = approx.sample_node(p, size=num_posterior, more_replacements={nn_input: x})
+			cache[key] = theano.function([x], probs.mean(axis=0))
+		return cache[key]
+
+	free = model.free_RVs
+	values = [trace.get_values(v.name, combine=True) for v in free]
+	n = len(values[0])
+	idx = np.unique(np.linspace(0, n - 1, min(num_posterior, n)).astype(int))
+	values = [np.asarray(val[idx], dtype=v.dtype) for val, v in zip(values, free)]
+
+	# The weights are inputs, so one compiled function serves every trace of
+	# this model (e.g. all points of a prior sweep)
+	cache = model.__dict__.setdefault('_trace_predictive', {})
+	if nn_input not in cache:
+		stacked = [T.TensorType(v.dtype, (False,) + v.broadcastable)(v.name) for v in free]
+		def sample_probs(*weights):
+			replace = dict(zip(free, weights))
+			replace[nn_input] = x
+			return theano.clone(p, replace=replace)
+		probs, _ = theano.scan(sample_probs, sequences=stacked)
+		cache[nn_input] = theano.function([x] + stacked, probs.mean(axis=0))
+	fn = cache[nn_input]
+	return lambda X: fn(X, *values)
+
+def predict_proba(predictive, X, chunk_size=1000):
+	""" Applies a compiled predictive function over X in chunks. """
+	precision.check('infer.predict_proba', X)
+	return np.concatenate([predictive(X[i:i+chunk_size].astype(floatX, copy=False))
+						   for i in range(0, len(X), chunk_size)])
\ No newline at end of file
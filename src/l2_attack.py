@@ -7,6 +7,7 @@
 
 import sys
 import tensorflow as tf
+import precision
 import numpy as np
 
 BINARY_SEARCH_STEPS = 9  # number of times to adjust the constant with binary search
@@ -16,6 +17,7 @@ LEARNING_RATE = 1e-2     # larger values converge faster to less accurate result
 TARGETED = True          # should we target one specific class? or just be wrong?
 CONFIDENCE = 0           # how strong the adversarial example should be
 INITIAL_CONST = 1e-3     # the initial constant c to pick as a first guess
+TF_FLOAT = tf.as_dtype(precision.FLOAT)  # dtype of the attack graph, see precision.py
 
 class CarliniL2:
     def __init__(self, sess, model, batch_size=1, confidence = CONFIDENCE,
@@ -69,17 +71,17 @@ class CarliniL2:
         shape = (batch_size,image_size,image_size,num_channels)
         
         # the variable we're going to optimize over
-        modifier = tf.Variable(np.zeros(shape,dtype=np.float32))
+        modifier = tf.Variable(np.zeros(shape,dtype=precision.FLOAT))
 
         # these are variables to be more efficient in sending data to tf
-        self.timg = tf.Variable(np.zeros(shape), dtype=tf.float32)
-        self.tlab = tf.Variable(np.zeros((batch_size,num_labels)), dtype=tf.float32)
-        self.const = tf.Variable(np.zeros(batch_size), dtype=tf.float32)
+        self.timg = tf.Variable(np.zeros(shape, dtype=precision.FLOAT))
+        self.tlab = tf.Variable(np.zeros((batch_size,num_labels), dtype=precision.FLOAT))
+        self.const = tf.Variable(np.zeros(batch_size, dtype=precision.FLOAT))
 
         # and here's what we use to assign them
-        self.assign_timg = tf.placeholder(tf.float32, shape)
-        self.assign_tlab = tf.placeholder(tf.float32, (batch_size,num_labels))
-        self.assign_const = tf.placeholder(tf.float32, [batch_size])
+        self.assign_timg = tf.placeholder(TF_FLOAT, shape)
+        self.assign_tlab = tf.placeholder(TF_FLOAT, (batch_size,num_labels))
+        self.assign_const = tf.placeholder(TF_FLOAT, [batch_size])
         
         # the resulting image, tanh'd to keep bounded from boxmin to boxmax
         self.boxmul = (boxmax - boxmin) / 2.
@@ -131,6 +133,7 @@ class CarliniL2:
         If self.targeted is true, then the targets represents the target labels.
         If self.targeted is false, then targets are the original class labels.
         """
+        precision.check(type(self).__name__ + '.attack', imgs, targets)
         r = []
         print('go up to',len(imgs))
         for i in range(0,len(imgs),self.batch_size):
@@ -161,14 +164,14 @@ class CarliniL2:
         imgs = np.arctanh((imgs - self.boxplus) / self.boxmul * 0.999999)
 
         # set the lower and upper bounds accordingly
-        lower_bound = np.zeros(batch_size)
-        CONST = np.ones(batch_size)*self.initial_const
-        upper_bound = np.ones(batch_size)*1e10
+        lower_bound = np.zeros(batch_size, dtype=precision.FLOAT)
+        CONST = np.full(batch_size, self.initial_const, dtype=precision.FLOAT)
+        upper_bound = np.full(batch_size, 1e10, dtype=precision.FLOAT)
 
         # the best l2, score, and image attack
         o_bestl2 = [1e10]*batch_size
         o_bestscore = [-1]*batch_size
-        o_bestattack = [np.zeros(imgs[0].shape)]*batch_size
+        o_bestattack = [np.zeros(imgs[0].shape, dtype=precision.FLOAT)]*batch_size
         
         for outer_step in range(self.BINARY_SEARCH_STEPS):
             print(o_bestl2)
@@ -1,57 +1,37 @@
 import numpy as np
 import sys, os
-import keras
-from keras.datasets import cifar10
-from keras.datasets import mnist
+import datacache
+import precision
 
-# TODO: We can use sklearn or keras to get datasets and not download the files.
-def load_MNIST_dataset():
-    from urllib.request import urlretrieve
-
-    def download(filename, source='http://yann.lecun.com/exdb/mnist/'):
-        print("Downloading %s" % filename)
-        urlretrieve(source + filename, filename)
-
-    # We then define functions for loading MNIST images and labels.
-    # For convenience, they also download the requested files if needed.
-    import gzip
-
-    def load_mnist_images(filename):
-        if not os.path.exists(filename):
-            download(filename)
-        # Read the inputs in Yann LeCun's binary format.
-        with gzip.open(filename, 'rb') as f:
-            data = np.frombuffer(f.read(), np.uint8, offset=16)
-        # The inputs are vectors now, we reshape them to monochrome 2D images,
-        # following the shape convention: (examples, channels, rows, columns)
-        data = data.reshape(-1, 1, 28, 28)
-        # The inputs come as bytes, we convert them to float32 in range [0,1].
-        # (Actually to range [0, 255/256], for compatibility to the version
-        # provided at http://deeplearning.net/data/mnist/mnist.pkl.gz.)
-        return data / np.float32(256)
-
-    def load_mnist_labels(filename):
-        if not os.path.exists(filename):
-            download(filename)
-        # Read the labels in Yann LeCun's binary format.
-        with gzip.open(filename, 'rb') as f:
-            data = np.frombuffer(f.read(), np.uint8, offset=8)
-        # The labels are vectors of integers now, that's exactly what we want.
-        return data
+def load_dataset(name, validation=False, raw=False):
+    """
+    Returns train and test datacache.Dataset objects for MNIST or CIFAR10,
+    each holding one contiguous precision.FLOAT buffer scaled to [0, 255/256]
+    (compatible with http://deeplearning.net/data/mnist/mnist.pkl.gz) and
+    integer labels. With validation=True, the MNIST validation split is
+    returned between the two. With raw=True the datasets are unscaled uint8
+    views of the memory-mapped cache, as used by minibatch.MinibatchStream.
+    """
+    d = datacache.load(name)
+    if raw:
+        train = datacache.Dataset(d["train_images"], d["train_labels"], dtype=np.uint8)
+        test = datacache.Dataset(d["test_images"], d["test_labels"], dtype=np.uint8)
+    else:
+        train = datacache.Dataset.from_uint8(d["train_images"], d["train_labels"], 1/256)
+        test = datacache.Dataset.from_uint8(d["test_images"], d["test_labels"], 1/256)
+    if name == "MNIST":
+        # We reserve the last 10000 training examples for validation.
+        train, val = train[:-10000], train[-10000:]
+        if validation:
+            return train, val, test
+    return train, test
 
-    # We can now download and read the training and test set images and labels.
-    X_train = load_mnist_images('train-images-idx3-ubyte.gz')
-    y_train = load_mnist_labels('train-labels-idx1-ubyte.gz')
-    X_test = load_mnist_images('t10k-images-idx3-ubyte.gz')
-    y_test = load_mnist_labels('t10k-labels-idx1-ubyte.gz')
-
-    # We reserve the last 10000 training examples for validation.
-    X_train, X_val = X_train[:-10000], X_train[-10000:]
-    y_train, y_val = y_train[:-10000], y_train[-10000:]
-
-    # We just return all the arrays in order, as expected in main().
-    # (It doesn't matter how we do this as long as we can read them again.)
-    return X_train, y_train, X_test, y_test
+def load_MNIST_dataset(validation=False):
+    # Images follow the shape convention (examples, channels, rows, columns)
+    train, val, test = load_dataset("MNIST", validation=True)
+    if validation:
+        return train.nchw, train.labels, val.nchw, val.labels, test.nchw, test.labels
+    return train.nchw, train.labels, test.nchw, test.labels
 
 '''
 def load_MNIST_dataset():
@@ -62,11 +42,13 @@ def load_MNIST_dataset():
 '''
 
 def load_CIFAR10_dataset():
-    (x_train, y_train), (x_test, y_test) = cifar10.load_data()
-    x_train = x_train / np.float32(256)
-    x_test = x_test / np.float32(256)
+    train, test = load_dataset("CIFAR10")
+    x_train, x_test = train.nhwc, test.nhwc
+    # Labels keep the (examples, 1) shape of keras.datasets.cifar10
+    y_train = train.labels[:, None]
+    y_test = test.labels[:, None]
 
-    def grayscale(data, dtype='float32'):
+    def grayscale(data, dtype=precision.FLOAT):
         # luma coding weighted average in video systems
         r, g, b = np.asarray(.3, dtype=dtype), np.asarray(.59, dtype=dtype), np.asarray(.11, dtype=dtype)
         rst = r * data[:, :, :, 0] + g * data[:, :, :, 1] + b * data[:, :, :, 2]
@@ -75,7 +57,7 @@ def load_CIFAR10_dataset():
         return rst
 
     def one_hot_encode(x):
-        encoded = np.zeros((len(x), 10))
+        encoded = np.zeros((len(x), 10), dtype=precision.FLOAT)
     
         for idx, val in enumerate(x):
             encoded[idx][val] = 1
@@ -1,6 +1,16 @@
+import compilecache
+import precision
+# Both set Theano flags, so they run before theano is imported
+compilecache.configure() # Persistent compiledir
+precision.configure_theano() # floatX = precision.FLOAT
 import model
 import infer
 import loaddata
+import datacache
+import minibatch
+import checkpoint
+import convergence
+import projection
 import numpy as np
 import theano
 floatX = theano.config.floatX
@@ -12,61 +22,129 @@ import time
 import sys
 
 ###################### Configurations ########################
-inference_alg = 'nuts'  # Can be advi, nuts, hmc
+inference_alg = 'nuts'  # Can be advi, nuts, hmc, sgld, sghmc
 modeltype = 'bnn' # can be bnn or bcnn
 data = 'MNIST' # can be MNIST or CIFAR10
 h_layer_size = 100
+input_rank = None # e.g. 20: low-rank (U.V) input layer weights for the BNN (prior mean must be 0)
+input_projection = None # 'pca' or 'random': project BNN inputs to projection_dim first
+projection_dim = 256
 mean = 0
 var = 1
+prior_sweep = None # e.g. [(0, 1), (0, 4)]: (mean, var) pairs trained one after another on one model
+layer_scales = None # e.g. {'in_1': .5}: per-layer multipliers of the prior sd, see model.LAYERS/LENET_LAYERS
 nPosterior_samples = 200
+nChains = 1 # NUTS/HMC chains, run in parallel processes when > 1
 test_trace = False # Setting this true will test the picked file only
-trace_save_filename = 'advi-bnn-MNIST.zip'
+trace_save_filename = 'advi-bnn-MNIST.trace' # trace store directory
+stream_minibatches = True # ADVI reads minibatches from the uint8 cache
+advi_iterations = 150000
+checkpoint_every = 10000 # ADVI snapshot interval, None disables snapshots
+resume = True # Continue ADVI from the latest snapshot if there is one
+early_stopping = True # Stop ADVI once parameters and windowed ELBO converge
+stream_draws = True # NUTS/HMC draws are written to disk while sampling (by each worker when nChains > 1)
+burn = 0 # Draws dropped after tuning
+thin = 1 # Keep every thin-th draw
+sgmcmc_burn = 10000 # SGLD/SGHMC iterations before the first kept sample
+sgmcmc_thin = 100 # SGLD/SGHMC iterations between kept samples
+sgmcmc_step_size = 1e-6
 ##############################################################
 
 def run_config(modeltype, inference_alg, data):
 	print('Trace name is ' + str(trace_save_filename))
-	if modeltype is 'bnn': # model is BNN
-		if data is 'MNIST':
-			X_train, Y_train, X_test, Y_test = loaddata.load_MNIST_dataset()
-		elif data is 'CIFAR10':
-			X_train, Y_train, X_test, Y_test = loaddata.load_CIFAR10_dataset()
-			Y_train = np.concatenate(Y_train)
-			Y_test = np.concatenate(Y_test)
-			Y_test = np.uint8(Y_test)
-		
-		X_train = np.asarray([entry.flatten() for entry in X_train])
-		X_test = np.asarray([entry.flatten() for entry in X_test])
-	elif modeltype is 'bcnn': # model is Bayesian CNN
-		if data is 'MNIST':
-			X_train, Y_train, X_test, Y_test = loaddata.load_MNIST_dataset()
-		elif data is 'CIFAR10':
-			X_train, Y_train, X_test, Y_test = loaddata.load_CIFAR10_dataset()
-			Y_train = np.concatenate(Y_train)
-			Y_test = np.concatenate(Y_test)
-			Y_test = np.uint8(Y_test)
+	# One contiguous float32 buffer per split; the BNN takes the flat view and
+	# the Bayesian CNN the NCHW view, neither of which copies it.
+	layout = 'flat' if modeltype == 'bnn' else 'nchw'
+	minibatches = None
+	if stream_minibatches and inference_alg in ('advi', 'sgld', 'sghmc') and not test_trace:
+		# Keep the training set as uint8 on disk; only the test set is scaled
+		train, test = loaddata.load_dataset(data, raw=True)
+		test = datacache.Dataset.from_uint8(test.nhwc, test.labels, 1/256)
+		minibatches = minibatch.MinibatchStream(train, layout=layout)
+	else:
+		train, test = loaddata.load_dataset(data)
+	X_train, X_test = getattr(train, layout), getattr(test, layout)
+	Y_train, Y_test = train.labels, test.labels
 
-	nn_input = theano.shared(X_train.astype(floatX))
-	nn_output = theano.shared(Y_train.astype(floatX))
+	if minibatches is not None:
+		# The model graph only needs a batch to fix its input shape
+		nn_input = theano.shared(minibatches.x.get_value())
+		nn_output = theano.shared(minibatches.y.get_value())
+	else:
+		nn_input = theano.shared(X_train.astype(floatX, copy=False), borrow=True)
+		nn_output = theano.shared(Y_train.astype(floatX))
+
+	# Fitted once, on training data scaled like the model's inputs, and
+	# cached alongside the trace for glue.BNN
+	proj = None
+	if input_projection is not None and modeltype == 'bnn':
+		proj_data, proj_scale = (train.nhwc, 1/256) if minibatches is not None else (X_train, 1.)
+		proj = projection.fit_cached(proj_data, input_projection, projection_dim,
+									trace_save_filename, scale=proj_scale)
+
+	# Start-up phases are timed against the first (cold) run of this architecture
+	timer = compilecache.CompileTimer(compilecache.arch_key(modeltype, data, h_layer_size, input_rank,
+															input_projection, projection_dim, floatX))
 
 	# Get neural network model
-	if modeltype is 'bnn':
-		nn = model.create_NN(h_layer_size, mean, var, nn_input, nn_output, X_train, Y_train)
-	elif modeltype is 'bcnn':
-		nn = model.create_NN(h_layer_size, mean, var, nn_input, nn_output, X_train, Y_train, conv=True)
+	with timer.phase('build'):
+		if modeltype is 'bnn':
+			nn = model.create_NN(h_layer_size, mean, var, nn_input, nn_output, X_train, Y_train,
+									layer_scales=layer_scales, rank=input_rank, projection=proj)
+		elif modeltype is 'bcnn':
+			nn = model.create_NN(h_layer_size, mean, var, nn_input, nn_output, X_train, Y_train, conv=True,
+									layer_scales=layer_scales)
 
 	if test_trace is True: # Testing only
 		loaded_trace = infer.load_trace(trace_save_filename)
-		pred_test = infer.eval_pickled_model(nn, nPosterior_samples, nn_input, nn_output, X_test, Y_test, loaded_trace)
-	else: # Train the model
-		if inference_alg is 'advi':
-			pred_test, trace = infer.train_model('advi', nn, nPosterior_samples, nn_input, nn_output, X_train, Y_train, X_test, Y_test)
-		elif inference_alg is 'nuts':
-			pred_test, trace = infer.train_model('nuts', nn, nPosterior_samples, nn_input, nn_output, X_train, Y_train, X_test, Y_test)
-		elif inference_alg is 'hmc':
-			pred_test, trace = infer.train_model('hmc', nn, nPosterior_samples, nn_input, nn_output, X_train, Y_train, X_test, Y_test)
-		infer.save_trace(trace, trace_save_filename)
+		with timer.phase('predictive'):
+			pred_test = infer.eval_pickled_model(nn, nPosterior_samples, nn_input, nn_output, X_test, Y_test, loaded_trace)
+	else: # Train the model, once per prior setting
+		# The prior is held in shared variables, so the model graph and the
+		# samplers compiled on it (see infer.py) are reused
+		priors = prior_sweep or [(mean, var)]
+		preds = []
+		for prior_mean, prior_var in priors:
+			trace_name = trace_save_filename
+			if prior_sweep:
+				model.set_prior(nn, prior_mean, prior_var, layer_scales)
+				trace_name = '%s.mean%g-var%g' % (trace_save_filename, prior_mean, prior_var)
+				print('Prior mean %g, var %g' % (prior_mean, prior_var))
+			if inference_alg is 'advi':
+				ckpt = None
+				if checkpoint_every:
+					ckpt = checkpoint.ADVICheckpoint(trace_name + '.ckpt.npz',
+													every=checkpoint_every, resume=resume)
+				stop = convergence.ConvergenceStop() if early_stopping else None
+				# Per-iteration ELBO and step times, streamed while fitting
+				elbo_log = convergence.ELBOLog(trace_name + '.elbo.csv',
+												start=ckpt.start if ckpt is not None else 0)
+				pred_test, trace = infer.train_model('advi', nn, nPosterior_samples, nn_input, nn_output, X_train, Y_train, X_test, Y_test,
+													minibatches=minibatches, n_iter=advi_iterations, checkpoint=ckpt,
+													early_stopping=stop, elbo_log=elbo_log, timer=timer)
+			elif inference_alg in ('nuts', 'hmc'):
+				# Partial runs can be loaded from <trace>.draws/chain-<n> while sampling
+				stream_dir = trace_name + '.draws' if stream_draws else None
+				pred_test, trace = infer.train_model(inference_alg, nn, nPosterior_samples, nn_input, nn_output, X_train, Y_train, X_test, Y_test,
+													chains=nChains, stream_dir=stream_dir, burn=burn, thin=thin, timer=timer)
+			elif inference_alg in ('sgld', 'sghmc'):
+				stream_dir = trace_name + '.draws' if stream_draws else None
+				sgmcmc_kwargs = {'burn': sgmcmc_burn, 'thin': sgmcmc_thin, 'step_size': sgmcmc_step_size}
+				pred_test, trace = infer.train_model(inference_alg, nn, nPosterior_samples, nn_input, nn_output, X_train, Y_train, X_test, Y_test,
+													minibatches=minibatches, stream_dir=stream_dir, sgmcmc_kwargs=sgmcmc_kwargs,
+													timer=timer)
+			infer.save_trace(trace, trace_name)
+			if proj is not None and trace_name != trace_save_filename:
+				proj.save(projection.path_for(trace_name))
+			preds.append(pred_test)
+	timer.report()
 	
 	# Calculate accuracy of the model trace
+	if prior_sweep and not test_trace:
+		accuracies = [accuracy_score(Y_test, p) for p in preds]
+		for (prior_mean, prior_var), acc in zip(prior_sweep, accuracies):
+			print('Prior mean %g, var %g: accuracy %.4f' % (prior_mean, prior_var, acc))
+		return np.array(accuracies)
 	accuracies = accuracy_score(Y_test, pred_test)
 	print(np.mean(np.argmax(Y_test,axis=1)==np.argmax(pred_test,axis=1)))
 
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""
+Converts legacy traces (theano.misc.pkl_utils zips such as
+pkls/<DATASET>-<INF>.zip, including ones pickled on GPU machines) into
+trace stores (see tracestore.py), one process per file.
+
+Usage:
+migrate_traces.py [--out DIR] [--processes N] [--no-verify] <trace.zip or dir> ...
+
+The pickle inside the zip is read with every class replaced by an inert
+stub and every array replaced by a lazy reference to its zip entry, so
+neither Theano, pymc3 nor a GPU is needed and no object graph is built.
+Variables are then copied one at a time into the store. Verification
+re-reads a few posterior samples straight from the zip and compares the
+logits of the dense BNN they define on a random probe batch. Traces of
+other architectures (e.g. LeNet, with 4-D conv kernels) are compared
+variable by variable instead.
+"""
+import argparse
+import glob
+import io
+import os
+import pickle
+import time
+import zipfile
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+import tracestore
+
+SAFE_MODULES = ("builtins", "collections", "numpy", "copyreg", "_codecs")
+
+
+class LazyArray(object):
+    """ A reference to an array stored as an entry of a pkl_utils zip. """
+    def __init__(self, zip_path, array_type, name):
+        self.zip_path = zip_path
+        self.array_type = array_type
+        self.name = name
+
+    def load(self):
+        with zipfile.ZipFile(self.zip_path) as z:
+            with z.open(self.name) as f:
+                f = io.BytesIO(f.read())
+        if self.array_type == "gpuarray":
+            pickle.load(f)  # context name, written ahead of the array
+        return np.lib.format.read_array(f)
+
+
+class Stub(object):
+    """ Stand-in for any class that is not needed to reach the samples. """
+    def __new__(cls, *args, **kwargs):
+        return object.__new__(cls)
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple) and len(state) == 2:
+            state = dict(state[0] or {}, **(state[1] or {}))
+        if isinstance(state, dict):
+            self.__dict__.update(state)
+        else:
+            self.state = state
+
+    def __setitem__(self, key, value):
+        self.__dict__.setdefault("items", {})[key] = value
+
+    def append(self, value):
+        self.__dict__.setdefault("list", []).append(value)
+
+    def extend(self, values):
+        self.__dict__.setdefault("list", []).extend(values)
+
+
+def _reconstructor(cls, base, state):
+    return object.__new__(cls) if issubclass(cls, Stub) else base.__new__(cls, state)
+
+
+class LazyUnpickler(pickle.Unpickler):
+    def __init__(self, f, zip_path):
+        super().__init__(f)
+        self.zip_path = zip_path
+        self.stubs = {}
+
+    def persistent_load(self, persid):
+        array_type, name = persid.split(".", 1)
+        return LazyArray(self.zip_path, array_type, name)
+
+    def find_class(self, module, name):
+        if module == "copyreg" and name == "_reconstructor":
+            return _reconstructor
+        if module.split(".")[0] in SAFE_MODULES:
+            return super().find_class(module, name)
+        key = module + "." + name
+        if key not in self.stubs:
+            self.stubs[key] = type(name, (Stub,), {"__module__": module})
+        return self.stubs[key]
+
+
+def read_legacy(zip_path):
+    """
+    Returns the per-chain sample dicts of a pickled MultiTrace, with values
+    as LazyArray references, and the variable names in model order.
+    """
+    with zipfile.ZipFile(zip_path) as z:
+        data = LazyUnpickler(io.BytesIO(z.open("pkl").read()), zip_path).load()
+    trace = data["trace"]
+    straces = trace.__dict__["_straces"]
+    chains = [straces[c].__dict__ for c in sorted(straces)]
+    varnames = list(chains[0]["varnames"])
+    return [c["samples"] for c in chains], varnames
+
+
+def migrate(zip_path, out_path):
+    """ Streams each variable of a legacy trace into a trace store. """
+    chains, varnames = read_legacy(zip_path)
+    # Only the first variable of each chain is read up front, for lengths and shapes
+    lengths = [len(samples[varnames[0]].load()) for samples in chains]
+    variables = OrderedDict()
+    for name in varnames:
+        first = chains[0][name].load()
+        variables[name] = (first.shape[1:], first.dtype)
+    writer = tracestore.StoreWriter(out_path, variables, sum(lengths),
+                                    chains=len(chains), source=os.path.basename(zip_path))
+    for name in varnames:
+        pos = 0
+        for samples, n in zip(chains, lengths):
+            writer.arrays[name][pos:pos+n] = samples[name].load()[:n]
+            pos += n
+        writer.arrays[name].flush()
+    writer.close(sum(lengths))
+    return chains, varnames, lengths
+
+
+def is_dense(weights):
+    """
+    Whether one posterior sample's weights form the dense BNN probe_logits
+    evaluates: (U,) W, b per layer, U and W matrices and b vectors.
+    """
+    layers = list(weights.values())
+    names = list(weights)
+    i = 0
+    while i < len(layers):
+        if names[i].endswith("_u"):
+            if layers[i].ndim != 2:
+                return False
+            i += 1
+        if i + 1 >= len(layers) or layers[i].ndim != 2 or layers[i+1].ndim != 1:
+            return False
+        i += 2
+    return True
+
+
+def probe_logits(weights, probe):
+    """ Logits of the dense tanh BNN given by one posterior sample. """
+    layers = list(weights.items())
+    h = probe
+    i = 0
+    while i < len(layers):
+        if layers[i][0].endswith("_u"):  # low-rank input layer factor
+            h = h.dot(layers[i][1])
+            i += 1
+        h = h.dot(layers[i][1]) + layers[i+1][1]
+        i += 2
+        if i < len(layers):
+            h = np.tanh(h)
+    return h
+
+
+def verify(zip_path, out_path, chains, varnames, lengths, num_checks=5, seed=0):
+    """
+    Max absolute difference between probe-batch logits computed from the
+    legacy zip and from the store, over a few random posterior samples, or
+    between their variables if the trace is not a dense BNN.
+    """
+    rng = np.random.RandomState(seed)
+    store = tracestore.load(out_path)
+    offsets = np.cumsum([0] + lengths)
+    probe = None
+    worst = 0.
+    for i in rng.choice(len(store), min(num_checks, len(store)), replace=False):
+        chain = np.searchsorted(offsets, i, side="right") - 1
+        legacy = OrderedDict((name, chains[chain][name].load()[i - offsets[chain]])
+                             for name in varnames)
+        stored = store.point(i)
+        if not is_dense(legacy):
+            for name in varnames:
+                worst = max(worst, float(np.abs(legacy[name] - stored[name]).max()))
+            continue
+        if probe is None:
+            probe = rng.uniform(-.5, .5, (64, legacy[varnames[0]].shape[0]))
+        diff = np.abs(probe_logits(legacy, probe) - probe_logits(stored, probe))
+        worst = max(worst, float(diff.max()))
+    return worst
+
+
+def convert(args):
+    zip_path, out_path, check = args
+    start = time.time()
+    try:
+        chains, varnames, lengths = migrate(zip_path, out_path)
+        err = verify(zip_path, out_path, chains, varnames, lengths) if check else None
+    except Exception as e:
+        return zip_path, out_path, None, time.time() - start, repr(e)
+    return zip_path, out_path, err, time.time() - start, None
+
+
+def output_path(zip_path, out_dir=None):
+    base = os.path.splitext(os.path.basename(zip_path))[0] + ".trace"
+    return os.path.join(out_dir or os.path.dirname(zip_path), base)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert legacy trace zips to trace stores")
+    parser.add_argument("inputs", nargs="+", help="Trace zips, or directories of them")
+    parser.add_argument("--out", default=None, help="Output directory (default: alongside input)")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--no-verify", dest="verify", action="store_false")
+    opts = parser.parse_args()
+
+    paths = []
+    for p in opts.inputs:
+        paths.extend(sorted(glob.glob(os.path.join(p, "*.zip"))) if os.path.isdir(p) else [p])
+    jobs = [(p, output_path(p, opts.out), opts.verify) for p in paths]
+
+    failed = 0
+    with Pool(opts.processes) as pool:
+        for zip_path, out_path, err, secs, error in pool.imap_unordered(convert, jobs):
+            if error is not None:
+                failed += 1
+                print("FAILED %s: %s" % (zip_path, error))
+            elif err is None:
+                print("%s -> %s (%.1fs)" % (zip_path, out_path, secs))
+            else:
+                print("%s -> %s (%.1fs, max diff %.2e)" % (zip_path, out_path, secs, err))
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,71 @@
+import numpy as np
+import theano
+floatX = theano.config.floatX
+import datacache
+
+
+class MinibatchStream:
+    def __init__(self, data, batch_size=500, layout='flat', scale=1/256, shift=0.,
+                 random_seed=None):
+        """
+        Streams shuffled minibatches from a uint8 datacache.Dataset (usually
+        memory-mapped) into a pair of Theano shared variables. Only the rows
+        of the current batch are read and converted to floatX, so peak memory
+        does not depend on the size of the dataset.
+
+        Use the shared variables x and y in pm.fit's more_replacements and
+        pass the stream itself as a callback, which loads the next batch
+        after every iteration.
+
+        Args:
+        - data: datacache.Dataset with uint8 NHWC images and integer labels
+        - batch_size: Number of examples per minibatch (default=500)
+        - layout: 'flat', 'nhwc' or 'nchw', the input layout of the model
+        - scale, shift: Normalization applied to each batch (default /256)
+        - random_seed: Seed for the shuffling order
+        """
+        self.data = data
+        self.batch_size = batch_size
+        self.layout = layout
+        self.scale = scale
+        self.shift = shift
+        self.rng = np.random.RandomState(random_seed)
+        self._batches = self.index_batches()
+
+        x, y = self.next_batch()
+        self.x = theano.shared(x, borrow=True)
+        self.y = theano.shared(y, borrow=True)
+
+    def __len__(self):
+        return len(self.data)
+
+    def index_batches(self):
+        """ Endless generator of index batches, reshuffled every epoch. """
+        n = len(self.data)
+        while True:
+            order = self.rng.permutation(n)
+            for i in range(0, n - self.batch_size + 1, self.batch_size):
+                # Sorted indices turn the memory-mapped gather into a forward scan
+                yield np.sort(order[i:i+self.batch_size])
+
+    def load(self, idx):
+        batch = datacache.Dataset.from_uint8(self.data.nhwc[idx], self.data.labels[idx],
+                                             self.scale, self.shift, dtype=floatX)
+        x = np.ascontiguousarray(getattr(batch, self.layout))
+        return x, np.asarray(batch.labels, dtype=floatX)
+
+    def next_batch(self):
+        return self.load(next(self._batches))
+
+    def __iter__(self):
+        while True:
+            yield self.next_batch()
+
+    def advance(self):
+        x, y = self.next_batch()
+        self.x.set_value(x, borrow=True)
+        self.y.set_value(y, borrow=True)
+
+    def __call__(self, approx, losses, i):
+        """ pm.fit callback: swap in the next minibatch. """
+        self.advance()
@@ -8,11 +8,8 @@ import theano.tensor as T
 import loaddata
 import math
 
-# For Bayesian CNN
-import keras
-from keras.models import Sequential
-from keras.layers.core import Activation
-from keras.layers import InputLayer, Dense, Conv2D, Flatten, MaxPooling2D
+from theano.tensor.nnet import conv2d
+from theano.tensor.signal.pool import pool_2d
 
 # For adding gaussian weights to Bayesian CNN
 class GaussWeights(object):
@@ -21,13 +18,65 @@ class GaussWeights(object):
     def __call__(self, shape):
         self.count += 1
         return pm.Normal('w%d' % self.count, mu=0, sd=.1,
-                         testval=np.random.normal(size=shape).astype(np.floatX),
+                         testval=np.random.normal(size=shape).astype(floatX),
                          shape=shape)
 
-def create_NN(n_hidden, mean, var, nn_input, nn_output, X_train, Y_train, conv=False, init=GaussWeights()):
+# Dense BNN layers, each with its own prior scale
+LAYERS = ('in_1', '1_2', '2_out')
+# Bayesian LeNet layers, in the order of glue.create_lenet
+LENET_LAYERS = ('conv_1', 'conv_2', 'dense_1', 'out')
+
+def prior_params(mean, var, fan_in, layer_scales=None):
+	"""
+	Prior hyperparameters as Theano shared variables: the mean, shared by
+	all weights, and one standard deviation per layer. Models built on them
+	can be re-pointed at new values with set_prior instead of being rebuilt
+	and recompiled.
+
+	fan_in maps each layer to the n in its default sd sqrt(var/n).
+	"""
+	prior = {'mean': theano.shared(np.asarray(mean, dtype=floatX), name='prior_mean'),
+			 'fan_in': dict(fan_in)}
+	for layer in fan_in:
+		prior['sd_' + layer] = theano.shared(np.asarray(1, dtype=floatX), name='prior_sd_' + layer)
+	update_prior(prior, mean, var, layer_scales)
+	return prior
+
+def update_prior(prior, mean, var, layer_scales=None):
+	"""
+	Sets the prior mean and the per-layer standard deviations
+	sqrt(var/fan_in) * layer_scales[layer] (default scale 1).
+	"""
+	layer_scales = layer_scales or {}
+	prior['mean'].set_value(np.asarray(mean, dtype=floatX))
+	for layer, n in prior['fan_in'].items():
+		sd = math.sqrt(var/n) * layer_scales.get(layer, 1.)
+		prior['sd_' + layer].set_value(np.asarray(sd, dtype=floatX))
+
+def set_prior(model, mean, var, layer_scales=None):
+	""" Re-points a model built by create_NN at new prior hyperparameters. """
+	if getattr(model, 'prior', None) is None:
+		raise ValueError("Model has no shared prior hyperparameters")
+	check_rank_mean(model.prior.get('rank'), mean)
+	update_prior(model.prior, mean, var, layer_scales)
+
+def check_rank_mean(rank, mean):
+	"""
+	The zero-mean factors of a low-rank input layer cannot represent a
+	nonzero prior mean of U.V, so it is rejected rather than ignored.
+	"""
+	if rank is not None and mean != 0:
+		raise ValueError("A low-rank input layer (rank %d) needs prior mean 0, got %g" % (rank, mean))
+
+def create_NN(n_hidden, mean, var, nn_input, nn_output, X_train, Y_train, conv=False,
+			  layer_scales=None, rank=None, projection=None):
 	if conv is False: # Create BNN
+		check_rank_mean(rank, mean)
+		# Inputs to the first layer, fewer if they are projected first
+		n_inputs = X_train.shape[1] if projection is None else projection.dim
+
 		# Initialize random weights between each layer
-		init_1 = np.random.randn(X_train.shape[1], n_hidden).astype(floatX)
+		init_1 = np.random.randn(n_inputs, n_hidden).astype(floatX)
 		init_2 = np.random.randn(n_hidden, n_hidden).astype(floatX)
 		init_out = np.random.randn(n_hidden, 10).astype(floatX)
 
@@ -36,99 +85,120 @@ def create_NN(n_hidden, mean, var, nn_input, nn_output, X_train, Y_train, conv=F
 		init_b_2 = np.random.randn(n_hidden).astype(floatX)
 		init_b_out = np.random.randn(10).astype(floatX)
 		
+		# Shared, so the prior can change without recompiling (see set_prior)
+		prior = prior_params(mean, var, {layer: n_hidden for layer in LAYERS}, layer_scales)
+		prior['rank'] = rank
+		mu = prior['mean']
+
 		with pm.Model() as model:
-			# Weights from input to hidden layer
-			weights_in_1 = pm.Normal('w_in_1', mu=mean, sd=math.sqrt(var/n_hidden),
-									shape=(X_train.shape[1], n_hidden), testval=init_1)
+			if projection is not None:
+				# Fixed, fitted linear projection of the input (see projection.py)
+				proj_W = theano.shared(projection.components.astype(floatX), name='proj_W')
+				proj_b = theano.shared(projection.bias.astype(floatX), name='proj_b')
+				layer_in = pm.math.dot(nn_input, proj_W) + proj_b
+			else:
+				layer_in = nn_input
+
+			if rank is None:
+				# Weights from input to hidden layer
+				weights_in_1 = pm.Normal('w_in_1', mu=mu, sd=prior['sd_in_1'],
+										shape=(n_inputs, n_hidden), testval=init_1)
+				hidden_in_1 = pm.math.dot(layer_in, weights_in_1)
+			else:
+				# Rank-r factors U, V of the input weights. Each factor's sd is
+				# chosen so the entries of U.V keep the prior variance. Their
+				# mean is 0 (the prior mean must be, see check_rank_mean).
+				# U.V is never formed: the input is projected to r dimensions first
+				sd_factor = T.sqrt(prior['sd_in_1'] / np.sqrt(rank).astype(floatX))
+				init_u = (np.random.randn(n_inputs, rank) / np.sqrt(np.sqrt(rank))).astype(floatX)
+				init_v = (np.random.randn(rank, n_hidden) / np.sqrt(np.sqrt(rank))).astype(floatX)
+				weights_in_1_u = pm.Normal('w_in_1_u', mu=0, sd=sd_factor,
+										shape=(n_inputs, rank), testval=init_u)
+				weights_in_1_v = pm.Normal('w_in_1_v', mu=0, sd=sd_factor,
+										shape=(rank, n_hidden), testval=init_v)
+				hidden_in_1 = pm.math.dot(pm.math.dot(layer_in, weights_in_1_u), weights_in_1_v)
 
 			# Add bias to first hidden layer
-			weights_in_b1 = pm.Normal('b_1', mu=mean, sd=math.sqrt(var/n_hidden), 
+			weights_in_b1 = pm.Normal('b_1', mu=mu, sd=prior['sd_in_1'], 
 									shape=(n_hidden), testval=init_b_1)
 			
 			# Weights from 1st to 2nd layer
-			weights_1_2 = pm.Normal('w_1_2', mu=mean, sd=math.sqrt(var/n_hidden), 
+			weights_1_2 = pm.Normal('w_1_2', mu=mu, sd=prior['sd_1_2'], 
 									shape=(n_hidden, n_hidden), testval=init_2)
 
 			# Add bias to second hidden layer
-			weights_in_b2 = pm.Normal('b_2', mu=mean, sd=math.sqrt(var/n_hidden), 
+			weights_in_b2 = pm.Normal('b_2', mu=mu, sd=prior['sd_1_2'], 
 									shape=(n_hidden), testval=init_b_2)
 			
 			# Weights from 2nd layer to output
-			weights_2_out = pm.Normal('w_2_out', mu=mean, sd=math.sqrt(var/n_hidden), 
+			weights_2_out = pm.Normal('w_2_out', mu=mu, sd=prior['sd_2_out'], 
 									shape=(n_hidden, 10), testval=init_out)
 
 			# Add bias to last hidden layer
-			weights_in_b_out = pm.Normal('b_out', mu=mean, sd=math.sqrt(var/n_hidden), 
+			weights_in_b_out = pm.Normal('b_out', mu=mu, sd=prior['sd_2_out'], 
 									shape=(10), testval=init_b_out)
 
 			# Build neural-network using activation function
-			act_1 = pm.math.tanh(pm.math.dot(nn_input, weights_in_1) + weights_in_b1)
+			act_1 = pm.math.tanh(hidden_in_1 + weights_in_b1)
 			act_2 = pm.math.tanh(pm.math.dot(act_1, weights_1_2) + weights_in_b2)
 			act_out = T.nnet.softmax(pm.math.dot(act_2, weights_2_out) + weights_in_b_out)
 			
 			# likelihood
 			out = pm.Categorical('out', p=act_out, observed=nn_output, total_size=Y_train.shape[0]) # IMPORTANT for minibatches
+		model.prior = prior
 
 		# debugging. Comment this out if not debugging!
 		#print(model.check_test_point())
 		#quit()
 	
 	else: # Bayesian Convolutional neural network (Lenet)
-		'''
-		model = Sequential()
-		# first set of CONV => RELU => POOL
-		model.add(Conv2D(20, kernel_size=(3, 3), padding="same", activation='relu',
-							input_shape=(X_train.shape[1], X_train.shape[2], 1)))
-		model.add(MaxPooling2D(pool_size=(2, 2), strides=(2, 2)))
-
-		# second set of CONV => RELU => POOL
-		model.add(Conv2D(50, kernel_size=(5, 5), activation='relu'))
-		model.add(MaxPooling2D(pool_size=(2, 2), strides=(2, 2)))
-
-		# set of FC => RELU layers
-		model.add(Flatten())
-		model.add(Dense(500))
-		model.add(Activation("relu"))
-
-		# softmax classifier
-		model.add(Dense(10))
-		model.add(Activation("softmax"))
-		'''
-
-		# Using keras
-		with pm.Model() as model:
-			#i = InputLayer(tensor=nn_input, shape=(X_train.shape[1], X_train.shape[2]))
-			i = InputLayer(input_shape=(X_train.shape[1], X_train.shape[2]))
-			layer1 = Conv2D(20, kernel_size=(5, 5), kernel_initializer=init, activation='relu')(i)
-			layer1Pool = MaxPooling2D(pool_size=(2, 2), strides=(2, 2))(layer1)
-
-			layer2 = Conv2D(50, kernel_size=(3, 3), kernel_initializer=init, activation='relu')(layer1Pool)
-			layer2Pool = MaxPooling2D(pool_size=(2, 2), strides=(2, 2))(layer2)
-
-			flatten = Flatten()(layer2Pool)
-			dense1 = Dense(500, kernel_initializer=init, activation='relu')(flatten)
-
-			dense2 = Dense(10, kernel_initializer=init, activation='softmax')(dense1)
+		# NCHW input, e.g. loaddata's nchw view or a MinibatchStream with
+		# layout='nchw'. The layers match glue.create_lenet: conv(20, 5x5,
+		# same)-relu-pool, conv(50, 5x5, same)-relu-pool, dense(500)-relu,
+		# dense(10), with weights in Keras layouts (kernels (kh, kw, in, out))
+		# so a posterior sample loads into the Keras model unchanged.
+		channels, size = X_train.shape[1], X_train.shape[2]
+		flat = (size // 4) * (size // 4) * 50
+		shapes = [('conv_1', (5, 5, channels, 20), 20),
+				  ('conv_2', (5, 5, 20, 50), 50),
+				  ('dense_1', (flat, 500), 500),
+				  ('out', (500, 10), 10)]
+		fan_in = {layer: int(np.prod(w_shape[:-1])) for layer, w_shape, _ in shapes}
+
+		# Shared, so the prior can change without recompiling (see set_prior)
+		prior = prior_params(mean, var, fan_in, layer_scales)
+		mu = prior['mean']
 
-			out = pm.Categorical('out', dense2, observed=nn_output, total_size=Y_train.shape[0])
-		
-		'''
-		# Using lasagne
-		import lasagne
 		with pm.Model() as model:
-			network = lasagne.layers.InputLayer(input_var=nn_input, shape=(None, 1, X_train.shape[1], X_train.shape[2]))
-			network = lasagne.layers.Conv2DLayer(network, num_filters=20, filter_size=(5, 5), W=init)
-			network = lasagne.layers.MaxPool2DLayer(network, pool_size=(2, 2), stride=(2, 2))
-
-			network = lasagne.layers.Conv2DLayer(network, num_filters=50, filter_size=(5, 5), W=init)
-			network = lasagne.layers.MaxPool2DLayer(network, pool_size=(2, 2), stride=(2, 2))
+			params = []
+			for layer, w_shape, b_shape in shapes:
+				# Small initial weights, N(0, 1) ones saturate the relus
+				sd_init = math.sqrt(1. / fan_in[layer])
+				w = pm.Normal('w_' + layer, mu=mu, sd=prior['sd_' + layer], shape=w_shape,
+							  testval=(np.random.randn(*w_shape) * sd_init).astype(floatX))
+				b = pm.Normal('b_' + layer, mu=mu, sd=prior['sd_' + layer], shape=b_shape,
+							  testval=np.zeros(b_shape, dtype=floatX))
+				params.append((w, b))
+			(w_1, b_1), (w_2, b_2), (w_3, b_3), (w_4, b_4) = params
+
+			# Keras (TF) convolutions are cross-correlations: no filter flip,
+			# and 'half' padding is 'same' for odd kernels
+			conv_1 = conv2d(nn_input, w_1.dimshuffle(3, 2, 0, 1), border_mode='half',
+							filter_flip=False)
+			act_1 = pool_2d(T.nnet.relu(conv_1 + b_1.dimshuffle('x', 0, 'x', 'x')),
+							ws=(2, 2), ignore_border=True)
+			conv_2 = conv2d(act_1, w_2.dimshuffle(3, 2, 0, 1), border_mode='half',
+							filter_flip=False)
+			act_2 = pool_2d(T.nnet.relu(conv_2 + b_2.dimshuffle('x', 0, 'x', 'x')),
+							ws=(2, 2), ignore_border=True)
+
+			# Flatten in NHWC order, as Keras' Flatten does
+			flattened = act_2.dimshuffle(0, 2, 3, 1).flatten(2)
+			act_3 = T.nnet.relu(pm.math.dot(flattened, w_3) + b_3)
+			act_out = T.nnet.softmax(pm.math.dot(act_3, w_4) + b_4)
 
-			network = lasagne.layers.FlattenLayer(network)
-			network = lasagne.layers.DenseLayer(network, 500, b=init, W=init)
-			network = lasagne.layers.DenseLayer(network, 10, b=init, W=init, nonlinearity=lasagne.nonlinearities.softmax)
-			prediction = lasagne.layers.get_output(network)
+			# likelihood
+			out = pm.Categorical('out', p=act_out, observed=nn_output, total_size=Y_train.shape[0]) # IMPORTANT for minibatches
+		model.prior = prior
 
-			out = pm.Categorical('out', prediction, observed=nn_output, total_size=Y_train.shape[0])
-		'''
-	
 	return model
\ No newline at end of file
@@ -11,26 +11,21 @@ import numpy as np
 from keras.models import Sequential
 from keras.layers import Dense, Dropout, Activation, Flatten
 from keras.layers import Conv2D, MaxPooling2D
-from keras.utils import np_utils, plot_model
 from keras.layers.core import Lambda
-from keras.callbacks import LearningRateScheduler
-from keras.optimizers import SGD
 import keras
 from utils import *
 
 import tensorflow as tf
-from setup_mnist import MNIST, MNISTModel
-from setup_cifar import CIFAR, CIFARModel
+import precision
 import os
 
 import sys
 sys.path.append("../..")
-from l2_attack import CarliniL2
 
-from glue import BNN
-import matplotlib
-import matplotlib.pyplot as plt
-from sklearn.metrics import auc, accuracy_score
+# The datasets (datacache) and models (setup_mnist, setup_cifar), the
+# single-model attack (l2_attack), glue, matplotlib and sklearn are imported
+# by the functions using them, so importing this module only loads the graph
+# code of the attacks themselves.
 
 def show(img):
     remap = "  .*#"+"#"*100
@@ -46,6 +41,7 @@ LEARNING_RATE = 1e-2     # larger values converge faster to less accurate result
 TARGETED = True          # should we target one specific class? or just be wrong?
 CONFIDENCE = 0           # how strong the adversarial example should be
 INITIAL_CONST = 1e-3     # the initial constant c to pick as a first guess
+TF_FLOAT = tf.as_dtype(precision.FLOAT)  # dtype of the attack graph, see precision.py
 ISMNIST = False
 class CarliniL2Multiple:
     def __init__(self, sess, models, batch_size=1, confidence = CONFIDENCE,
@@ -61,6 +57,8 @@ class CarliniL2Multiple:
 
         Returns adversarial examples for the supplied model.
 
+        models: A list of models with predict(), or a glue.BNN, whose
+          sample_logits() evaluates all of its posterior samples at once.
         confidence: Confidence of adversarial examples: higher produces examples
           that are farther away, but more strongly classified as adversarial.
         batch_size: Number of attacks to run simultaneously.
@@ -78,7 +76,9 @@ class CarliniL2Multiple:
           the initial constant is not important.
         """
 
-        image_size, num_channels, num_labels = models[0].image_size, models[0].num_channels, models[0].num_labels
+        ensemble = hasattr(models, 'sample_logits')
+        first = models if ensemble else models[0]
+        image_size, num_channels, num_labels = first.image_size, first.num_channels, first.num_labels
         self.sess = sess
         self.TARGETED = targeted
         self.LEARNING_RATE = learning_rate
@@ -94,26 +94,30 @@ class CarliniL2Multiple:
         shape = (batch_size,image_size,image_size,num_channels)
         
         # the variable we're going to optimize over
-        modifier = tf.Variable(np.zeros(shape,dtype=np.float32))
+        modifier = tf.Variable(np.zeros(shape,dtype=precision.FLOAT))
 
         # these are variables to be more efficient in sending data to tf
-        self.timg = tf.Variable(np.zeros(shape), dtype=tf.float32)
-        self.tlab = tf.Variable(np.zeros((batch_size,num_labels)), dtype=tf.float32)
-        self.const = tf.Variable(np.zeros(batch_size), dtype=tf.float32)
+        self.timg = tf.Variable(np.zeros(shape, dtype=precision.FLOAT))
+        self.tlab = tf.Variable(np.zeros((batch_size,num_labels), dtype=precision.FLOAT))
+        self.const = tf.Variable(np.zeros(batch_size, dtype=precision.FLOAT))
 
         # and here's what we use to assign them
-        self.assign_timg = tf.placeholder(tf.float32, shape)
-        self.assign_tlab = tf.placeholder(tf.float32, (batch_size,num_labels))
-        self.assign_const = tf.placeholder(tf.float32, [batch_size])
+        self.assign_timg = tf.placeholder(TF_FLOAT, shape)
+        self.assign_tlab = tf.placeholder(TF_FLOAT, (batch_size,num_labels))
+        self.assign_const = tf.placeholder(TF_FLOAT, [batch_size])
         
         # the resulting image, tanh'd to keep bounded from -0.5 to 0.5
         self.newimg = tf.tanh(modifier + self.timg)/2
         
         # prediction BEFORE-SOFTMAX of the model
-        outs = []
-        for model in models:
-            outs.append(model.predict(self.newimg))
-        self.outputs = tf.transpose(tf.stack(outs), [1, 0, 2])
+        if ensemble:
+            # (batch, samples, labels) in one stacked-weight pass
+            self.outputs = models.sample_logits(self.newimg)
+        else:
+            outs = []
+            for model in models:
+                outs.append(model.predict(self.newimg))
+            self.outputs = tf.transpose(tf.stack(outs), [1, 0, 2])
         print(self.outputs.get_shape())
         
         # distance to the input data
@@ -162,6 +166,7 @@ class CarliniL2Multiple:
         If self.targeted is true, then the targets represents the target labels.
         If self.targeted is false, then targets are the original class labels.
         """
+        precision.check(type(self).__name__ + '.attack', imgs, targets)
         r = []
         print('go up to',len(imgs))
         for i in range(0,len(imgs),self.batch_size):
@@ -189,14 +194,14 @@ class CarliniL2Multiple:
         imgs = np.arctanh(imgs*1.999999)
 
         # set the lower and upper bounds accordingly
-        lower_bound = np.zeros(batch_size)
-        CONST = np.ones(batch_size)*self.initial_const
-        upper_bound = np.ones(batch_size)*1e10
+        lower_bound = np.zeros(batch_size, dtype=precision.FLOAT)
+        CONST = np.full(batch_size, self.initial_const, dtype=precision.FLOAT)
+        upper_bound = np.full(batch_size, 1e10, dtype=precision.FLOAT)
 
         # the best l2, score, and image attack
         o_bestl2 = [1e10]*batch_size
         o_bestscore = [-1]*batch_size
-        o_bestattack = [np.zeros(imgs[0].shape)]*batch_size
+        o_bestattack = [np.zeros(imgs[0].shape, dtype=precision.FLOAT)]*batch_size
         
         for outer_step in range(self.BINARY_SEARCH_STEPS):
             #print(o_bestl2)
@@ -327,12 +332,16 @@ def differentable_u(modeld, data, count):
 
 def differentiable_u_multiple(models, data):
 
-    ys = []
-    for model in models:
-        ys.append(tf.nn.softmax(model(data)))
+    if hasattr(models, 'sample_logits'):
+        # glue.BNN: all posterior samples in one pass
+        ys = tf.nn.softmax(models.sample_logits(data))
+    else:
+        ys = []
+        for model in models:
+            ys.append(tf.nn.softmax(model(data)))
 
-    ys = tf.stack(ys)
-    ys = tf.transpose(ys, perm=[1, 0, 2])
+        ys = tf.stack(ys)
+        ys = tf.transpose(ys, perm=[1, 0, 2])
 
     term1 = tf.reduce_mean(tf.reduce_sum(ys**2,axis=2),axis=1)
 
@@ -351,6 +360,7 @@ def gray_box(clean_x, clean_y, confidence, model):
     single_model = model.model_list[np.random.choice(len(model.model_list),1)[0]]#np.random.choice(model.model_list, 1)
     # print(type(single_model))
     # print(type(model.model))
+    from l2_attack import CarliniL2
     sess = keras.backend.get_session()
     attack = CarliniL2(sess, Wrap(single_model), batch_size=20, max_iterations=10000,#1000
                        binary_search_steps=9, learning_rate=1e-2, initial_const=1e-3,
@@ -359,14 +369,9 @@ def gray_box(clean_x, clean_y, confidence, model):
     return adv
 
 def white_box(clean_x, clean_y, confidence, model):
-    all_models = model.model_list
-    indices = np.random.choice(len(model.model_list), size=50, replace=False)
-    models = []
-    for i in indices:
-        models.append(all_models[i])
-    # models = np.random.choice(all_models, size=20, replace=False)
+    # Attacks all of the BNN's posterior samples, evaluated together
     sess = keras.backend.get_session()
-    attack = CarliniL2Multiple(sess, [Wrap(m) for m in models], batch_size=20, binary_search_steps=9,
+    attack = CarliniL2Multiple(sess, model, batch_size=20, binary_search_steps=9,
                            initial_const=1e-3, max_iterations=10000, confidence=confidence, #1000 iters
                            targeted=False, abort_early=True, learning_rate=1e-2)
     adv = attack.attack(clean_x, clean_y)
@@ -378,13 +383,18 @@ def eval_model(model, clean_x, clean_y, adv):
     adv_preds = model.model.predict(adv)
     adv_acc = np.mean(np.argmax(adv_preds,axis=1) == np.argmax(clean_y,axis=1))
     dist = np.mean([np.linalg.norm(clean_x[i]-adv[i]) for i in range(len(clean_x))])
-    models = model.model_list
+    from glue import WeightSwapper
+    if isinstance(model.model, WeightSwapper):
+        # Samples streamed through one template: uncertainties in numpy
+        _, clean_unc = model.model.evaluate(clean_x)
+        _, adv_unc = model.model.evaluate(adv)
+        return adv_acc, dist, (clean_unc, adv_unc)
     if ISMNIST:
-        p = tf.placeholder(tf.float32, (None, 28, 28, 1))
+        p = tf.placeholder(TF_FLOAT, (None, 28, 28, 1))
     else:
-        p = tf.placeholder(tf.float32, (None, 32, 32, 3))
-    r1 = differentiable_u_multiple(models, p)
-    r2 = differentiable_u_multiple(models, p)
+        p = tf.placeholder(TF_FLOAT, (None, 32, 32, 3))
+    r1 = differentiable_u_multiple(model, p)
+    r2 = differentiable_u_multiple(model, p)
     clean_unc = sess.run(r1, {p: clean_x})
     adv_unc = sess.run(r2, {p: adv})
     #print('uncertainty on test data', np.mean((sess.run(r, {p: data.test_data[:N]}))))
@@ -395,7 +405,20 @@ def eval_model(model, clean_x, clean_y, adv):
     #       np.mean(clean_unc), np.mean(adv_unc))
     return adv_acc, dist, (clean_unc, adv_unc)
 
+def attack_data(dataset, n=20):
+    """
+    The first n test images of dataset as a datacache.Dataset, converted
+    from the cached uint8 store with the models' scale x/255 - .5 (as
+    setup_mnist.MNIST and setup_cifar.CIFAR), with one-hot labels.
+    """
+    import datacache
+    d = datacache.load(dataset)
+    return datacache.Dataset.from_uint8(d["test_images"][:n], datacache.one_hot(d["test_labels"][:n]),
+                                        1/255, -.5)
+
 def run_attacks():
+    import matplotlib.pyplot as plt
+    from glue import BNN
     datasets = ["CIFAR10", "MNIST"]
     inf_methods = ["ADVI", "NUTS"]#, "HMC", "MCDROP"]
     colors = ["gray", "white"]
@@ -403,21 +426,21 @@ def run_attacks():
     for dataset in datasets:
         for inf in inf_methods:
             global ISMNIST
-            if dataset == "MNIST":
-                ISMNIST = True
-                data = MNIST()
-            else:
-                ISMNIST = False
-                data = CIFAR()
+            ISMNIST = dataset == "MNIST"
+            # Only the attacked images are converted to floats
+            data = attack_data(dataset)
             #standardize naming of pkls between comps in some way
-            path = "pkls/" + dataset + "-" + inf + ".zip"
+            path = "pkls/" + dataset + "-" + inf + ".trace"
+            if not os.path.isdir(path):
+                # Not yet converted with migrate_traces.py
+                path = "pkls/" + dataset + "-" + inf + ".zip"
             try:
                 # print(path)
                 model = BNN(path, ISMNIST=ISMNIST)
             except(FileNotFoundError):
                 pass
-            clean_x = data.test_data[:20]
-            clean_y = data.test_labels[:20]
+            clean_x = data.nhwc
+            clean_y = data.labels
             g_results = [[],[],[]]
             w_results = [[],[],[]]
             for conf in confs:
@@ -465,15 +488,17 @@ def run_attacks():
 
 # confs = [0,1,2,3,4,5,6,7,8,9,10,20,50] 
 def run_mc_drop():
+    import matplotlib.pyplot as plt
+    from setup_cifar import CIFARModel
     global ISMNIST
     ISMNIST = False
     keras.backend.set_learning_phase(False)
     model = make_model(CIFARModel, dropout=True)
     model.load_weights("models/MCDrop-cifar")
-    data = CIFAR()
+    data = attack_data("CIFAR10")
     confs = [0,0.25,0.5,1,2,4,8,12,16,24,32,48,64]
-    clean_x = data.test_data[:20]
-    clean_y = data.test_labels[:20]
+    clean_x = data.nhwc
+    clean_y = data.labels
     g_results = [[],[],[]]
     w_results = [[],[],[]]
     for conf in confs:
@@ -524,6 +549,7 @@ def run_mc_drop():
                 np.mean(w_results[2][i][0]), np.mean(w_results[2][i][1])))
 
 def roc_auc(clean_us, adv_us):
+    from sklearn.metrics import auc
     uncertainties = np.concatenate((np.stack((clean_us, np.zeros(len(clean_us))),axis=-1), np.stack((adv_us, np.ones(len(adv_us))),axis=-1)))
     # print(uncertainties)
     uncertainties = uncertainties[uncertainties[:,0].argsort()][::-1]
@@ -561,6 +587,7 @@ def mc_drop_gray_box(clean_x, clean_y, confidence, model):
     single_model = make_model(model, dropout=True)
     single_model.load_weights("models/MCDrop-cifar")    # print(type(single_model))
     # print(type(model.model))
+    from l2_attack import CarliniL2
     sess = keras.backend.get_session()
     attack = CarliniL2(sess, Wrap(single_model), batch_size=20, max_iterations=1000,#1000
                        binary_search_steps=3, learning_rate=1e-1, initial_const=1,
@@ -596,9 +623,9 @@ def mc_drop_eval_model(model, clean_x, clean_y, adv):
     adv_acc = np.mean(np.argmax(adv_preds,axis=1) == np.argmax(clean_y,axis=1))
     dist = np.mean([np.linalg.norm(clean_x[i]-adv[i]) for i in range(len(clean_x))])
     if ISMNIST:
-        p = tf.placeholder(tf.float32, (None, 28, 28, 1))
+        p = tf.placeholder(TF_FLOAT, (None, 28, 28, 1))
     else:
-        p = tf.placeholder(tf.float32, (None, 32, 32, 3))
+        p = tf.placeholder(TF_FLOAT, (None, 32, 32, 3))
     r1 = differentiable_u_multiple(models, p)
     r2 = differentiable_u_multiple(models, p)
     clean_unc = sess.run(r1, {p: clean_x})
@@ -612,6 +639,7 @@ def mc_drop_eval_model(model, clean_x, clean_y, adv):
     return adv_acc, dist, (clean_unc, adv_unc)
 
 def plot_results(dataset, inf, color):
+    import matplotlib.pyplot as plt
     path = "results/{}_{}_{}".format(dataset, inf, color)
     title_desc = "{} {} {}box".format(dataset, inf, color)
     filename = "plots/{}_{}_{}".format(dataset, inf, color)
@@ -662,6 +690,7 @@ def plot_results(dataset, inf, color):
 
 
 def test(Model, data, path):
+    from l2_attack import CarliniL2
     keras.backend.set_learning_phase(False)
     model = make_model(Model, dropout=False)
     model.load_weights(path)
@@ -708,9 +737,9 @@ def test(Model, data, path):
     # uncertainty than the test images, but again with a 3x increase in distortion.
 
     if ISMNIST:
-        p = tf.placeholder(tf.float32, (None, 28, 28, 1))
+        p = tf.placeholder(TF_FLOAT, (None, 28, 28, 1))
     else:
-        p = tf.placeholder(tf.float32, (None, 32, 32, 3))
+        p = tf.placeholder(TF_FLOAT, (None, 32, 32, 3))
     r = differentable_u(modeld, p, 100)    
 
     models = []
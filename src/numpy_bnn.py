@@ -0,0 +1,163 @@
+import numpy as np
+import tracestore
+import projection
+import precision
+
+# Dense BNN posterior predictive in plain numpy: the same tanh MLP as
+# glue.create_model / ensemble.create_ensemble, evaluated for every posterior
+# sample at once with batched matmuls. No TensorFlow, Keras or Theano is
+# imported, so offline evaluation (accuracy, uncertainty, ROC) runs without a
+# session. Inputs are processed in chunks sized to a memory budget.
+
+# Default bound on the activations held at once, in bytes
+MEMORY_BUDGET = 256 * 2**20
+
+
+class NumpyBNN:
+    def __init__(self, weights, proj=None, memory_budget=MEMORY_BUDGET):
+        """
+        Args:
+        - weights: Ordered mapping of layer names to (samples, *shape) arrays,
+        as returned by stack_weights
+        - proj: projection.Projection applied to the flattened input
+        (default=None)
+        - memory_budget: Bytes of activations per chunk of inputs
+        (default=MEMORY_BUDGET)
+        """
+        self.proj = proj
+        self.memory_budget = memory_budget
+        # (U, W, b) per layer, U the low-rank input factor or None. The
+        # architecture is inferred from the names as in glue.create_model.
+        self.layers = []
+        items = [(name, precision.compute(data)) for name, data in weights.items()]
+        i = 0
+        while i < len(items):
+            u = None
+            if items[i][0].endswith('_u'):
+                u = items[i][1]
+                i += 1
+            self.layers.append((u, items[i][1], items[i+1][1]))
+            i += 2
+        self.num_samples = len(self.layers[0][1])
+        self.num_labels = self.layers[-1][1].shape[-1]
+
+    @classmethod
+    def from_trace(cls, path, num_samples=50, burnin=100, ids=None, seed=None, **kwargs):
+        """
+        Loads posterior samples from a trace store, chosen after burnin as in
+        glue.BNN, with the input projection saved alongside it, if any.
+        Legacy pickled traces can be converted with migrate_traces.py.
+
+        Args:
+        - path: Trace store directory
+        - num_samples: Number of posterior samples to use (default=50)
+        - burnin: Length of burn-in phase (default=100)
+        - ids: Explicit sample indices, overriding num_samples/burnin
+        - seed: Seed for the choice of samples (default=None)
+        """
+        if not tracestore.is_store(path):
+            raise ValueError("%s is not a trace store, convert it with migrate_traces.py" % path)
+        trace = tracestore.load(path)
+        if ids is None:
+            rng = np.random.RandomState(seed)
+            ids = rng.choice(range(burnin, len(trace)), num_samples, replace=False)
+        return cls(trace.select(np.sort(ids)), projection.load_for(path), **kwargs)
+
+    def chunk_size(self):
+        """ Inputs per chunk so the widest layer's activations fit the budget. """
+        widths = [self.layers[0][1].shape[-2]] + [w.shape[-1] for _, w, _ in self.layers]
+        row_bytes = self.num_samples * max(widths) * precision.FLOAT.itemsize
+        # Two live activations per layer (input and output)
+        return max(1, self.memory_budget // (2 * row_bytes))
+
+    def _logits(self, x):
+        """ (samples, n, labels) logits for a chunk of flattened inputs. """
+        if self.proj is not None:
+            x = self.proj.apply(x).astype(precision.FLOAT, copy=False)
+        # (n, in) @ (samples, in, out) broadcasts to (samples, n, out)
+        h = x
+        for i, (u, w, b) in enumerate(self.layers):
+            if u is not None:
+                h = np.matmul(h, u)
+            h = np.matmul(h, w)
+            h += b[:, None, :]
+            if i < len(self.layers) - 1:
+                np.tanh(h, out=h)
+        return h
+
+    def _chunks(self, X):
+        X = precision.check('NumpyBNN', np.asarray(X))
+        X = X.reshape(len(X), -1)
+        step = self.chunk_size()
+        for start in range(0, len(X), step):
+            yield start, precision.compute(X[start:start+step])
+
+    def sample_logits(self, X):
+        """ (n, samples, labels) logits of every posterior sample. """
+        out = np.empty((len(X), self.num_samples, self.num_labels), dtype=precision.FLOAT)
+        for start, x in self._chunks(X):
+            out[start:start+len(x)] = self._logits(x).transpose(1, 0, 2)
+        return out
+
+    def predict_proba(self, X):
+        """ Posterior predictive: per-sample softmaxes, averaged. """
+        return self.evaluate(X)[0]
+
+    def uncertainty(self, X):
+        """ Predictive uncertainty, as new_attack.differentiable_u_multiple. """
+        return self.evaluate(X)[1]
+
+    def evaluate(self, X):
+        """
+        Averaged probabilities (n, labels) and uncertainties (n,) in one pass
+        over X, without keeping the per-sample outputs of more than one chunk.
+        """
+        probs = np.empty((len(X), self.num_labels), dtype=precision.FLOAT)
+        unc = np.empty(len(X), dtype=precision.FLOAT)
+        for start, x in self._chunks(X):
+            ys = softmax(self._logits(x))
+            probs[start:start+len(x)], unc[start:start+len(x)] = moments(ys)
+        return probs, unc
+
+
+def stack_weights(trace, ids):
+    """
+    Ordered mapping of variable name to the (len(ids), *shape) stack of its
+    values at the given sample indices.
+    """
+    if hasattr(trace, 'select'):  # trace store
+        return trace.select(ids)
+    points = [trace.point(i) for i in ids]
+    return type(points[0])((name, np.stack([p[name] for p in points]))
+                           for name in points[0])
+
+
+def softmax(logits):
+    """ Softmax over the last axis, in place. """
+    logits -= logits.max(axis=-1, keepdims=True)
+    np.exp(logits, out=logits)
+    logits /= logits.sum(axis=-1, keepdims=True)
+    return logits
+
+
+def moments(ys):
+    """
+    Mean probabilities and uncertainty E[sum p^2] - sum E[p]^2 of
+    (samples, n, labels) per-sample probabilities.
+    """
+    mean = ys.mean(axis=0)
+    term1 = np.einsum('snl,snl->n', ys, ys) / len(ys)
+    term2 = np.einsum('nl,nl->n', mean, mean)
+    return mean, term1 - term2
+
+
+def eval_model(bnn, clean_x, clean_y, adv):
+    """
+    new_attack.eval_model for a NumpyBNN: adversarial accuracy, mean L2
+    distortion, and clean and adversarial uncertainties (for roc_auc).
+    """
+    adv_preds, adv_unc = bnn.evaluate(adv)
+    _, clean_unc = bnn.evaluate(clean_x)
+    adv_acc = np.mean(np.argmax(adv_preds, axis=1) == np.argmax(clean_y, axis=1))
+    dist = np.mean(np.linalg.norm((np.asarray(clean_x) - np.asarray(adv)).reshape(len(adv), -1), axis=1))
+    return adv_acc, dist, (clean_unc, adv_unc)
@@ -0,0 +1,177 @@
+import os
+import pickle
+import time
+import multiprocessing
+import numpy as np
+
+import compilecache
+
+# Workers must configure Theano before importing it, so this module only
+# imports theano/pymc3 inside functions. A spawned worker re-runs the
+# parent's main module (e.g. master.py, which imports Theano) before
+# _chain_worker, so its compiledir is passed in THEANO_FLAGS when it is
+# started rather than set by the worker.
+
+
+# Compiled functions and step methods cached on a model (see infer.py and
+# sgmcmc.compiled_step). Workers build their own.
+COMPILED_CACHES = ('_minibatch', '_advi_step', '_mcmc_step', '_sgmcmc',
+                   '_approx_predictive', '_trace_predictive')
+
+
+def model_payload(model):
+    """ The pickled model, without the compiled functions cached on it. """
+    cached = {key: model.__dict__.pop(key) for key in COMPILED_CACHES if key in model.__dict__}
+    try:
+        return pickle.dumps(model)
+    finally:
+        model.__dict__.update(cached)
+
+
+def _chain_worker(payload, chain, seed, compiledir, step, sample_kwargs, stream, queue):
+    compilecache.set_compiledir(compiledir)  # only effective if theano is not imported yet
+    import theano
+    import pymc3 as pm
+
+    try:
+        used = theano.config.compiledir
+        if os.path.realpath(used) != os.path.realpath(compiledir):
+            raise RuntimeError("worker compiledir is %s, expected %s" % (used, compiledir))
+        start = time.time()
+        model = pickle.loads(payload)
+        if stream is not None:
+            # Draws go straight to this chain's trace store, only its path
+            # is sent back
+            import streamtrace
+            path, burn, thin, flush_every = stream
+            backend = streamtrace.StreamingTrace(streamtrace.chain_path(path, chain), burn=burn,
+                                                 thin=thin, flush_every=flush_every, chain=chain,
+                                                 model=model)
+            sample_kwargs = dict(sample_kwargs, trace=backend, discard_tuned_samples=False)
+        with model:
+            # With step=None pm.sample runs its NUTS initialization (init=...)
+            step_method = pm.HamiltonianMC(step_scale=0.15) if step == 'hmc' else None
+            trace = pm.sample(step=step_method, chains=1, cores=1, chain_idx=chain,
+                              random_seed=seed, progressbar=False,
+                              compute_convergence_checks=False, **sample_kwargs)
+        samples = None if stream is not None else {v: trace.get_values(v) for v in trace.varnames}
+        queue.put((chain, samples, time.time() - start, None))
+    except Exception as e:
+        queue.put((chain, None, 0., repr(e)))
+
+
+def merge_chains(model, chain_samples):
+    """
+    Builds a pymc3 MultiTrace from per-chain dicts of sample arrays, in the
+    same form pm.sample returns, so it can be summarized and saved as usual.
+    """
+    import pymc3 as pm
+
+    straces = []
+    for chain in sorted(chain_samples):
+        samples = chain_samples[chain]
+        strace = pm.backends.NDArray(model=model)
+        num_draws = len(next(iter(samples.values())))
+        strace.setup(num_draws, chain)
+        for i in range(num_draws):
+            strace.record({v: samples[v][i] for v in strace.varnames})
+        strace.close()
+        straces.append(strace)
+    return pm.backends.base.MultiTrace(straces)
+
+
+def sample_chains(model, chains, step='nuts', random_seed=None, compiledir_root=None,
+                  timer=None, stream_dir=None, burn=0, thin=1, flush_every=50, tune=500,
+                  **sample_kwargs):
+    """
+    Runs MCMC chains in parallel, one spawned process per chain, each with
+    an independent seed and its own Theano compiledir. Returns the merged
+    MultiTrace and a report with the wall-clock speedup over running the
+    chains back to back and the Gelman-Rubin statistic across chains.
+    logp/dlogp is compiled here first and each worker's compiledir is
+    pre-warmed with the result (see compilecache.py).
+    With stream_dir set, each worker streams its chain to a trace store
+    under it (see streamtrace.py) and the returned MultiTrace reads them.
+
+    Args:
+    - model: pymc3 Model to sample from (must be picklable)
+    - chains: Number of chains/processes
+    - step: 'nuts' or 'hmc'
+    - random_seed: Base seed from which the chain seeds are derived
+    - compiledir_root: Parent directory of the per-worker compiledirs
+    - timer: compilecache.CompileTimer to record the pre-warm in
+    - stream_dir: Directory of per-chain trace stores (default=None, chains
+    are sent back in memory)
+    - burn, thin, flush_every: Streaming settings, see
+    streamtrace.StreamingTrace. Tuning draws are dropped before burn.
+    - tune: Tuning draws per chain (default=500)
+    - sample_kwargs: Passed on to pm.sample in each worker (draws, tune, init...)
+    """
+    import pymc3 as pm
+    import theano
+
+    start = time.time()
+    model.logp_dlogp_function()
+    copied = compilecache.prewarm(chains, compiledir_root, src=theano.config.compiledir)
+    prewarm_time = time.time() - start
+    if timer is not None:
+        timer.times['prewarm'] = timer.times.get('prewarm', 0.) + prewarm_time
+    print("Pre-warmed %d worker compiledirs in %.1fs (%d modules copied)"
+          % (chains, prewarm_time, copied))
+
+    seeds = [int(s.generate_state(1)[0]) for s in
+             np.random.SeedSequence(random_seed).spawn(chains)]
+    payload = model_payload(model)
+
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    start = time.time()
+    compiledirs = [compilecache.worker_compiledir(c, compiledir_root) for c in range(chains)]
+    stream = None if stream_dir is None else (stream_dir, tune + burn, thin, flush_every)
+    sample_kwargs = dict(sample_kwargs, tune=tune)
+    procs = [ctx.Process(target=_chain_worker,
+                         args=(payload, c, seeds[c], compiledirs[c], step, sample_kwargs,
+                               stream, queue))
+             for c in range(chains)]
+    # Children inherit the environment at start(), before they import Theano
+    parent_flags = os.environ.get("THEANO_FLAGS")
+    try:
+        for p, compiledir in zip(procs, compiledirs):
+            compilecache.set_compiledir(compiledir)
+            p.start()
+    finally:
+        if parent_flags is None:
+            os.environ.pop("THEANO_FLAGS", None)
+        else:
+            os.environ["THEANO_FLAGS"] = parent_flags
+    # Drain the queue before joining, large results would block the workers
+    results = [queue.get() for _ in procs]
+    for p in procs:
+        p.join()
+    wall = time.time() - start
+
+    errors = [(c, err) for c, _, _, err in results if err is not None]
+    if errors:
+        raise RuntimeError("Chains failed: %s" % errors)
+
+    if stream_dir is not None:
+        import streamtrace
+        trace = pm.backends.base.MultiTrace(
+            [streamtrace.open_chain(streamtrace.chain_path(stream_dir, c), model=model)
+             for c in range(chains)])
+    else:
+        trace = merge_chains(model, {c: samples for c, samples, _, _ in results})
+    chain_times = [t for _, _, t, _ in results]
+    report = {'wall_time': wall,
+              'prewarm_time': prewarm_time,
+              'chain_times': chain_times,
+              'speedup': sum(chain_times) / wall}
+    if chains > 1:
+        rhat = pm.diagnostics.gelman_rubin(trace)
+        report['max_rhat'] = {v: float(np.max(r)) for v, r in rhat.items()}
+
+    print("Sampled %d chains in %.1fs (%.2fx speedup over sequential)"
+          % (chains, wall, report['speedup']))
+    if 'max_rhat' in report:
+        print("Max Gelman-Rubin R-hat per variable: %s" % report['max_rhat'])
+    return trace, report
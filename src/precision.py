@@ -0,0 +1,62 @@
+import os
+import warnings
+import numpy as np
+
+# Precision policy shared by inference (Theano/pymc3), trace stores, glue.BNN
+# and the attacks (Keras/TensorFlow):
+# - FLOAT is the compute dtype everywhere (float32 unless ROBUSTBNN_FLOAT is
+# set), including Theano's floatX and Keras' floatx.
+# - STORAGE is the dtype float arrays are written to disk in (trace stores;
+# datasets are cached as uint8). ROBUSTBNN_STORAGE=float16 halves trace size,
+# values are cast back to FLOAT when read.
+# - check() flags wider-than-FLOAT arrays reaching hot paths, which would
+# otherwise be upcast silently. With ROBUSTBNN_STRICT_PRECISION=1 it raises.
+FLOAT = np.dtype(os.environ.get("ROBUSTBNN_FLOAT", "float32"))
+STORAGE = np.dtype(os.environ.get("ROBUSTBNN_STORAGE", FLOAT.name))
+STRICT = os.environ.get("ROBUSTBNN_STRICT_PRECISION", "0") not in ("", "0")
+
+
+class PrecisionWarning(UserWarning):
+    pass
+
+
+def configure_theano():
+    """ Sets Theano's floatX to FLOAT. Must run before theano is imported. """
+    flags = [f for f in os.environ.get("THEANO_FLAGS", "").split(",")
+             if f and not f.startswith("floatX=")]
+    os.environ["THEANO_FLAGS"] = ",".join(flags + ["floatX=" + FLOAT.name])
+
+
+def configure_keras():
+    """ Sets Keras' floatx to FLOAT. """
+    from keras import backend as K
+    K.set_floatx(FLOAT.name)
+
+
+def is_float(dtype):
+    return np.issubdtype(np.dtype(dtype), np.floating)
+
+
+def storage_dtype(dtype):
+    """ The on-disk dtype for arrays of dtype: STORAGE for floats. """
+    return STORAGE if is_float(dtype) else np.dtype(dtype)
+
+
+def compute(x):
+    """ x as an array, with floats cast to FLOAT (no copy if already FLOAT). """
+    x = np.asarray(x)
+    return x.astype(FLOAT, copy=False) if is_float(x.dtype) else x
+
+
+def check(where, *arrays):
+    """
+    Flags float arrays wider than FLOAT passed to `where`. Returns the
+    arrays unchanged so it can wrap arguments inline.
+    """
+    for x in arrays:
+        if isinstance(x, np.ndarray) and is_float(x.dtype) and x.dtype.itemsize > FLOAT.itemsize:
+            msg = "%s got a %s array, expected %s" % (where, x.dtype, FLOAT)
+            if STRICT:
+                raise TypeError(msg)
+            warnings.warn(msg, PrecisionWarning, stacklevel=2)
+    return arrays[0] if len(arrays) == 1 else arrays
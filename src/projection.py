@@ -0,0 +1,96 @@
+import os
+import numpy as np
+
+# Fitted linear input projections x -> (x - mean).W for the dense BNN. They
+# are applied inside the pymc3 model and as a fixed Dense layer in the Keras
+# models of glue.BNN, so attacks still see (and perturb) pixels. Only numpy
+# is needed to fit, save or load one.
+
+
+class Projection:
+    def __init__(self, mean, components, kind):
+        """
+        Args:
+        - mean: (D,) input mean subtracted before projecting
+        - components: (D, k) projection matrix
+        - kind: 'pca' or 'random'
+        """
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+        self.kind = str(kind)
+
+    @property
+    def dim(self):
+        return self.components.shape[1]
+
+    @property
+    def bias(self):
+        """ Bias of the equivalent affine map x.W + b. """
+        return -self.mean.dot(self.components)
+
+    def apply(self, X):
+        X = np.asarray(X).reshape(len(X), -1)
+        return (X - self.mean).dot(self.components)
+
+    def save(self, path):
+        np.savez(path, mean=self.mean, components=self.components, kind=self.kind)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['mean'], f['components'], f['kind'])
+
+
+def sample_rows(X, max_samples, seed=0, scale=1.):
+    """ Up to max_samples random rows of X, flattened, as float64. """
+    rng = np.random.RandomState(seed)
+    n = len(X)
+    idx = np.sort(rng.choice(n, min(n, max_samples), replace=False))
+    return np.asarray(X[idx], dtype=np.float64).reshape(len(idx), -1) * scale
+
+
+def fit_pca(X, dim, max_samples=10000, seed=0, scale=1.):
+    """
+    PCA projection onto the top `dim` principal components, fitted on up to
+    max_samples rows of X (which may be a uint8 memmap; rows are multiplied
+    by scale first).
+    """
+    sample = sample_rows(X, max_samples, seed, scale)
+    mean = sample.mean(axis=0)
+    _, _, vt = np.linalg.svd(sample - mean, full_matrices=False)
+    return Projection(mean, vt[:dim].T, 'pca')
+
+
+def fit_random(X, dim, max_samples=10000, seed=0, scale=1.):
+    """
+    Fixed Gaussian random projection, scaled by 1/sqrt(dim) so distances
+    are preserved in expectation. The mean is still estimated from X.
+    """
+    mean = sample_rows(X, max_samples, seed, scale).mean(axis=0)
+    rng = np.random.RandomState(seed)
+    return Projection(mean, rng.randn(len(mean), dim) / np.sqrt(dim), 'random')
+
+
+def path_for(trace_path):
+    """ The projection file kept alongside a trace. """
+    return trace_path.rstrip('/' + os.sep) + '.projection.npz'
+
+
+def load_for(trace_path):
+    """ The projection saved alongside a trace, or None. """
+    path = path_for(trace_path)
+    return Projection.load(path) if os.path.exists(path) else None
+
+
+def fit_cached(X, kind, dim, trace_path, scale=1., **kwargs):
+    """
+    Loads the projection cached alongside trace_path if it has the requested
+    kind and dimension, otherwise fits and caches a new one.
+    """
+    cached = load_for(trace_path)
+    if cached is not None and cached.kind == kind and cached.dim == dim:
+        return cached
+    fit = {'pca': fit_pca, 'random': fit_random}[kind]
+    proj = fit(X, dim, scale=scale, **kwargs)
+    proj.save(path_for(trace_path))
+    return proj
@@ -14,6 +14,7 @@ import gzip
 import pickle
 import urllib.request
 
+import datacache
 from resnet import ResnetBuilder
 from keras.models import Sequential
 from keras.layers import Dropout, Flatten, Dense, Activation
@@ -41,48 +42,47 @@ def load_batch(fpath, label_key='labels'):
 
     return final, labels
 
+def normalize(images):
+    return datacache.scaled(images, 1/255, -.5)
+
 def load_batch(fpath):
-    f = open(fpath,"rb").read()
-    size = 32*32*3+1
-    labels = []
-    images = []
-    for i in range(10000):
-        arr = np.fromstring(f[i*size:(i+1)*size],dtype=np.uint8)
-        lab = np.identity(10)[arr[0]]
-        img = arr[1:].reshape((3,32,32)).transpose((1,2,0))
-
-        labels.append(lab)
-        images.append((img/255)-.5)
-    return np.array(images),np.array(labels)
-    
+    images, labels = datacache.decode_cifar10_batches([fpath])
+    return normalize(images), datacache.one_hot(labels)
+
 
 class CIFAR:
     def __init__(self):
-        train_data = []
-        train_labels = []
-        
-        if not os.path.exists("cifar-10-batches-bin"):
-            urllib.request.urlretrieve("https://www.cs.toronto.edu/~kriz/cifar-10-binary.tar.gz",
-                                       "cifar-data.tar.gz")
-            os.popen("tar -xzf cifar-data.tar.gz").read()
-            
-
-        for i in range(5):
-            r,s = load_batch("cifar-10-batches-bin/data_batch_"+str(i+1)+".bin")
-            train_data.extend(r)
-            train_labels.extend(s)
-            
-        train_data = np.array(train_data,dtype=np.float32)
-        train_labels = np.array(train_labels)
-        
-        self.test_data, self.test_labels = load_batch("cifar-10-batches-bin/test_batch.bin")
-        
+        d = datacache.load("CIFAR10")
+
         VALIDATION_SIZE = 5000
-        
-        self.validation_data = train_data[:VALIDATION_SIZE, :, :, :]
+
+        # uint8 views; normalized to float32 only when first accessed
+        self.raw = {"validation": d["train_images"][:VALIDATION_SIZE],
+                    "train": d["train_images"][VALIDATION_SIZE:],
+                    "test": d["test_images"]}
+        self._normalized = {}
+
+        train_labels = datacache.one_hot(d["train_labels"])
         self.validation_labels = train_labels[:VALIDATION_SIZE]
-        self.train_data = train_data[VALIDATION_SIZE:, :, :, :]
         self.train_labels = train_labels[VALIDATION_SIZE:]
+        self.test_labels = datacache.one_hot(d["test_labels"])
+
+    def _data(self, split):
+        if split not in self._normalized:
+            self._normalized[split] = normalize(self.raw[split])
+        return self._normalized[split]
+
+    @property
+    def train_data(self):
+        return self._data("train")
+
+    @property
+    def validation_data(self):
+        return self._data("validation")
+
+    @property
+    def test_data(self):
+        return self._data("test")
 
 # class CIFARModel:
 #     def __init__(self, restore=None, session=None, Dropout=Dropout, num_labels=10):
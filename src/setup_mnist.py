@@ -12,6 +12,7 @@ import pickle
 import gzip
 import urllib.request
 
+import datacache
 from keras.models import Sequential
 from keras.layers import Dense, Dropout, Activation, Flatten
 from keras.layers import Conv2D, MaxPooling2D, Dropout
@@ -20,45 +21,39 @@ from keras.regularizers import l2
 from keras.utils import np_utils
 from keras.models import load_model
 
-def extract_data(filename, num_images):
-    with gzip.open(filename) as bytestream:
-        bytestream.read(16)
-        buf = bytestream.read(num_images*28*28)
-        data = np.frombuffer(buf, dtype=np.uint8).astype(np.float32)
-        data = (data / 255) - 0.5
-        data = data.reshape(num_images, 28, 28, 1)
-        return data
-
-def extract_labels(filename, num_images):
-    with gzip.open(filename) as bytestream:
-        bytestream.read(8)
-        buf = bytestream.read(1 * num_images)
-        labels = np.frombuffer(buf, dtype=np.uint8)
-    return (np.arange(10) == labels[:, None]).astype(np.float32)
-
 class MNIST:
     def __init__(self):
-        if not os.path.exists("data"):
-            os.mkdir("data")
-            files = ["train-images-idx3-ubyte.gz",
-                     "t10k-images-idx3-ubyte.gz",
-                     "train-labels-idx1-ubyte.gz",
-                     "t10k-labels-idx1-ubyte.gz"]
-            for name in files:
-
-                urllib.request.urlretrieve('http://yann.lecun.com/exdb/mnist/' + name, "data/"+name)
-
-        train_data = extract_data("data/train-images-idx3-ubyte.gz", 60000)
-        train_labels = extract_labels("data/train-labels-idx1-ubyte.gz", 60000)
-        self.test_data = extract_data("data/t10k-images-idx3-ubyte.gz", 10000)
-        self.test_labels = extract_labels("data/t10k-labels-idx1-ubyte.gz", 10000)
-        
+        d = datacache.load("MNIST")
+
         VALIDATION_SIZE = 5000
-        
-        self.validation_data = train_data[:VALIDATION_SIZE, :, :, :]
+
+        # uint8 views; normalized to float32 only when first accessed
+        self.raw = {"validation": d["train_images"][:VALIDATION_SIZE],
+                    "train": d["train_images"][VALIDATION_SIZE:],
+                    "test": d["test_images"]}
+        self._normalized = {}
+
+        train_labels = datacache.one_hot(d["train_labels"])
         self.validation_labels = train_labels[:VALIDATION_SIZE]
-        self.train_data = train_data[VALIDATION_SIZE:, :, :, :]
         self.train_labels = train_labels[VALIDATION_SIZE:]
+        self.test_labels = datacache.one_hot(d["test_labels"])
+
+    def _data(self, split):
+        if split not in self._normalized:
+            self._normalized[split] = datacache.scaled(self.raw[split], 1/255, -.5)
+        return self._normalized[split]
+
+    @property
+    def train_data(self):
+        return self._data("train")
+
+    @property
+    def validation_data(self):
+        return self._data("validation")
+
+    @property
+    def test_data(self):
+        return self._data("test")
 
 
 # class MNISTModel:
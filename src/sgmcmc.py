@@ -0,0 +1,122 @@
+import time
+from collections import OrderedDict
+import numpy as np
+import theano
+import theano.tensor as T
+from theano.sandbox.rng_mrg import MRG_RandomStreams
+import pymc3 as pm
+floatX = theano.config.floatX
+
+
+def sgld_updates(params, grads, step_size, srng):
+    """
+    Stochastic gradient Langevin dynamics (Welling & Teh, 2011):
+    theta += step_size/2 * grad log p(theta | minibatch) + N(0, step_size)
+    """
+    updates = OrderedDict()
+    for p, g in zip(params, grads):
+        noise = srng.normal(p.get_value().shape, std=np.sqrt(step_size), dtype=p.dtype)
+        updates[p] = p + np.asarray(step_size / 2, dtype=p.dtype) * g + noise
+    return updates
+
+
+def sghmc_updates(params, grads, step_size, friction, srng):
+    """
+    Stochastic gradient HMC (Chen et al., 2014) in its momentum-SGD form:
+    v = (1 - friction) * v + step_size * grad + N(0, 2 * friction * step_size)
+    theta += v
+    """
+    updates = OrderedDict()
+    for p, g in zip(params, grads):
+        value = p.get_value()
+        v = theano.shared(np.zeros_like(value), name=p.name + '_momentum')
+        noise = srng.normal(value.shape, std=np.sqrt(2 * friction * step_size), dtype=p.dtype)
+        v_new = (np.asarray(1 - friction, dtype=p.dtype) * v
+                 + np.asarray(step_size, dtype=p.dtype) * g + noise)
+        updates[v] = v_new
+        updates[p] = p + v_new
+    return updates
+
+
+def compiled_step(model, nn_input, nn_output, batch_x, batch_y, method, step_size,
+                  friction, random_seed=None):
+    """
+    The shared parameters and compiled update step of an SG-MCMC sampler
+    on model, with the shared variables the step updates and their initial
+    values. Compiled once per model and settings and cached on the model,
+    so a prior sweep (model.set_prior only changes shared hyperparameters)
+    reuses it. random_seed only seeds the noise of the first compilation.
+    """
+    cache = model.__dict__.setdefault('_sgmcmc', {})
+    key = (method, nn_input, batch_x, step_size, friction)
+    if key not in cache:
+        free = model.vars
+        point = model.test_point
+        params = [theano.shared(np.asarray(point[v.name], dtype=v.dtype), name=v.name)
+                  for v in free]
+        logp = theano.clone(model.logpt, replace=dict(zip(free, params)))
+        grads = T.grad(logp, params)
+
+        srng = MRG_RandomStreams(random_seed if random_seed is not None else np.random.randint(2**30))
+        if method == 'sgld':
+            updates = sgld_updates(params, grads, step_size, srng)
+        elif method == 'sghmc':
+            updates = sghmc_updates(params, grads, step_size, friction, srng)
+        else:
+            raise ValueError("Unknown SG-MCMC method %s" % method)
+        step = theano.function([], logp, updates=updates,
+                               givens={nn_input: batch_x, nn_output: batch_y})
+        # Parameters and SGHMC momenta (the noise streams update themselves)
+        state = list(updates)
+        cache[key] = (params, step, state, [var.get_value() for var in state])
+    return cache[key]
+
+
+def sample(model, nn_input, nn_output, batch_x, batch_y, method='sgld', draws=200,
+           burn=10000, thin=100, step_size=1e-6, friction=0.05, callback=None,
+           trace=None, random_seed=None, progress_every=1000):
+    """
+    Samples the posterior of a pymc3 model with minibatch SG-MCMC. Gradients
+    are those of model.logpt, which the likelihood's total_size already
+    rescales from a minibatch to the full training set. Returns a pymc3
+    MultiTrace, so the result is summarized, saved and loaded by glue.BNN
+    like a NUTS trace.
+
+    Args:
+    - model: pymc3 Model, built on nn_input/nn_output
+    - nn_input, nn_output: Shared variables the model was built on
+    - batch_x, batch_y: Minibatch tensors substituted for them, e.g. a
+    minibatch.MinibatchStream's x and y, or pm.Minibatch
+    - method: 'sgld' or 'sghmc'
+    - draws: Number of posterior samples to keep (default=200)
+    - burn: Iterations before the first kept sample (default=10000)
+    - thin: Iterations between kept samples (default=100)
+    - step_size: Step size (SGLD) or learning rate (SGHMC) (default=1e-6)
+    - friction: SGHMC momentum decay (default=0.05)
+    - callback: Called with no arguments after every iteration, e.g. to
+    load the next minibatch (MinibatchStream.advance)
+    - trace: pymc3 backend for the kept samples (default: NDArray)
+    - random_seed: Seed for the injected noise
+    """
+    free = model.vars
+    params, step, state, initial = compiled_step(model, nn_input, nn_output, batch_x, batch_y,
+                                                 method, step_size, friction, random_seed)
+    # A fresh chain from the test point, also when the step is reused
+    for var, value in zip(state, initial):
+        var.set_value(value)
+
+    strace = trace if trace is not None else pm.backends.NDArray(model=model)
+    strace.setup(draws, 0)
+    n_iter = burn + draws * thin
+    start = time.time()
+    for i in range(1, n_iter + 1):
+        loss = step()
+        if callback is not None:
+            callback()
+        if i > burn and (i - burn) % thin == 0:
+            strace.record({v.name: p.get_value() for v, p in zip(free, params)})
+        if progress_every and i % progress_every == 0:
+            print("%s iteration %d/%d, minibatch logp %.1f, %.1f it/s"
+                  % (method.upper(), i, n_iter, loss, i / (time.time() - start)))
+    strace.close()
+    return pm.backends.base.MultiTrace([strace])
@@ -0,0 +1,172 @@
+import os
+from collections import OrderedDict
+import numpy as np
+import pymc3 as pm
+from pymc3.backends.base import BaseTrace, MultiTrace
+import tracestore
+import precision
+
+
+class StreamingTrace(BaseTrace):
+    supports_sampler_stats = True
+
+    def __init__(self, path, burn=0, thin=1, flush_every=50, chain=0, model=None, vars=None):
+        """
+        pymc3 sampling backend that writes each kept draw straight into a
+        trace store (see tracestore.py) instead of holding the chain in
+        memory. The first `burn` draws are dropped and afterwards only every
+        `thin`-th draw is kept. The store's manifest is rewritten every
+        `flush_every` kept draws, so a partial run can be loaded (e.g. by
+        glue.BNN) while sampling continues, and survives a crash.
+
+        pm.sample records tuning draws too, so burn should be at least tune,
+        with discard_tuned_samples=False. One instance holds one chain, see
+        streaming_traces for several.
+
+        Args:
+        - path: Trace store directory for this chain
+        - burn: Number of leading draws to drop (default=0)
+        - thin: Keep every thin-th draw after burn-in (default=1)
+        - flush_every: Kept draws between manifest updates (default=50)
+        - chain: Chain number
+        """
+        super(StreamingTrace, self).__init__(path, model=model, vars=vars)
+        self.path = path
+        self.burn = burn
+        self.thin = thin
+        self.flush_every = flush_every
+        self.chain = chain
+        self.writer = None
+        self.arrays = None
+        self.seen = 0
+        self.draw_idx = 0
+        self._stats = None
+        self._store = None
+
+    def setup(self, draws, chain, sampler_vars=None):
+        super(StreamingTrace, self).setup(draws, chain, sampler_vars)
+        self.chain = chain
+        capacity = max(0, -(-(draws - self.burn) // self.thin))
+        variables = OrderedDict((name, (self.var_shapes[name], self.var_dtypes[name]))
+                                for name in self.varnames)
+        self.writer = tracestore.StoreWriter(self.path, variables, capacity,
+                                             chains=1, chain=chain, burn=self.burn,
+                                             thin=self.thin)
+        self.arrays = self.writer.arrays
+        self.seen = 0
+        self.draw_idx = 0
+        if sampler_vars is not None:
+            # Per-draw scalars, small enough to keep in memory
+            self._stats = [{key: np.zeros(capacity, dtype=dtype) for key, dtype in svars.items()}
+                           for svars in sampler_vars]
+        self.writer.flush(0)
+
+    def record(self, point, sampler_stats=None):
+        seen, self.seen = self.seen, self.seen + 1
+        if seen < self.burn or (seen - self.burn) % self.thin:
+            return
+        for name, value in zip(self.varnames, self.fn(point)):
+            self.arrays[name][self.draw_idx] = value
+        if sampler_stats is not None:
+            for data, stats in zip(self._stats, sampler_stats):
+                for key, val in stats.items():
+                    data[key][self.draw_idx] = val
+        self.draw_idx += 1
+        if self.draw_idx % self.flush_every == 0:
+            self.writer.flush(self.draw_idx)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close(self.draw_idx)
+            self.writer = None
+            self.arrays = None
+        if self._stats is not None:
+            np.savez(os.path.join(self.path, "sampler_stats.npz"),
+                     **{"%d.%s" % (i, key): data[:self.draw_idx]
+                        for i, stats in enumerate(self._stats) for key, data in stats.items()})
+
+    def __len__(self):
+        return self.draw_idx
+
+    def store(self):
+        """ Read-only memory-mapped view of the kept draws. """
+        if self._store is None or self._store.num_samples != self.draw_idx:
+            self._store = tracestore.load(self.path)
+        return self._store
+
+    def get_values(self, varname, burn=0, thin=1):
+        values = self.arrays[varname] if self.arrays is not None else self.store().array(varname)
+        return precision.compute(values[:self.draw_idx][burn::thin])
+
+    def _get_sampler_stats(self, varname, sampler_idx, burn, thin):
+        return self._stats[sampler_idx][varname][:self.draw_idx][burn::thin]
+
+    def _slice(self, idx):
+        idx = slice(*idx.indices(len(self)))
+        if idx == slice(0, len(self), 1):
+            return self
+        # Memory-mapped views of the store, nothing is copied
+        sliced = pm.backends.NDArray(model=self.model, vars=self.vars)
+        sliced.chain = self.chain
+        sliced.samples = {name: self.get_values(name)[idx] for name in self.varnames}
+        sliced.sampler_vars = self.sampler_vars
+        sliced.draw_idx = len(range(idx.start, idx.stop, idx.step))
+        if self._stats is not None:
+            sliced._stats = [{key: data[:self.draw_idx][idx] for key, data in stats.items()}
+                             for stats in self._stats]
+        return sliced
+
+    def point(self, idx):
+        idx = int(idx)
+        return {name: np.array(self.get_values(name)[idx]) for name in self.varnames}
+
+
+def chain_path(path, chain):
+    return os.path.join(path, "chain-%d" % chain)
+
+
+def open_chain(path, model=None, vars=None):
+    """
+    A finished StreamingTrace read back from its trace store, e.g. a chain
+    streamed by a worker process (see parallel.sample_chains).
+    """
+    store = tracestore.load(path)
+    trace = StreamingTrace(path, burn=store.manifest.get("burn", 0), thin=store.manifest.get("thin", 1),
+                           chain=store.manifest.get("chain", 0), model=model, vars=vars)
+    trace._store = store
+    trace.draw_idx = len(store)
+    stats_path = os.path.join(path, "sampler_stats.npz")
+    if os.path.exists(stats_path):
+        stats = {}
+        with np.load(stats_path) as f:
+            for key in f.files:
+                i, name = key.split(".", 1)
+                stats.setdefault(int(i), {})[name] = f[key]
+        trace._stats = [stats[i] for i in sorted(stats)]
+        trace.sampler_vars = [{key: data.dtype for key, data in s.items()} for s in trace._stats]
+    return trace
+
+
+def streaming_traces(path, chains=1, burn=0, thin=1, flush_every=50, model=None):
+    """
+    A MultiTrace of StreamingTraces, one store per chain under path, to pass
+    to pm.sample as trace= (with chains= the same and cores=1).
+    """
+    return MultiTrace([StreamingTrace(chain_path(path, c), burn=burn, thin=thin,
+                                      flush_every=flush_every, chain=c, model=model)
+                       for c in range(chains)])
+
+
+def sample(model, path, chains=1, draws=500, tune=500, burn=0, thin=1, flush_every=50,
+           **sample_kwargs):
+    """
+    pm.sample with every chain streamed to its own trace store under path.
+    Tuning draws and then `burn` more are dropped, and every thin-th draw
+    is kept. Chains run one after another in this process, see
+    parallel.sample_chains(stream_dir=...) to run them in parallel.
+    """
+    traces = streaming_traces(path, chains=chains, burn=tune + burn, thin=thin,
+                              flush_every=flush_every, model=model)
+    with model:
+        return pm.sample(draws=draws, tune=tune, chains=chains, cores=1, trace=traces,
+                         discard_tuned_samples=False, **sample_kwargs)
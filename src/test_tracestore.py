@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+import tracestore
+
+
+def truncated_store(path, written=3, capacity=5):
+    """ A store preallocated for capacity samples with only written valid. """
+    writer = tracestore.StoreWriter(str(path), {"w": ((2,), np.float32)}, capacity)
+    writer.arrays["w"][:written] = np.arange(1, written * 2 + 1).reshape(written, 2)
+    writer.flush(written)
+    return tracestore.load(str(path))
+
+
+def test_truncated_store_reads_written_samples(tmp_path):
+    store = truncated_store(tmp_path)
+    assert len(store) == 3
+    np.testing.assert_array_equal(store.point(2)["w"], [5, 6])
+    np.testing.assert_array_equal(store.point(-1)["w"], [5, 6])
+    np.testing.assert_array_equal(store.select([0, 2])["w"], [[1, 2], [5, 6]])
+    assert len(store.get_values("w")) == 3
+
+
+def test_truncated_store_rejects_unwritten_samples(tmp_path):
+    store = truncated_store(tmp_path)
+    with pytest.raises(IndexError):
+        store.point(3)
+    with pytest.raises(IndexError):
+        store.point(-4)
+    with pytest.raises(IndexError):
+        store.select([0, 4])
@@ -0,0 +1,182 @@
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+import precision
+
+# A trace store is a directory holding one contiguous (num_samples, *shape)
+# .npy array per variable and a small JSON manifest listing the variables in
+# model order. Arrays are memory-mapped, so reading a few posterior samples
+# touches only those rows, and loading needs neither Theano nor pymc3.
+# Floats are written as precision.STORAGE and read back as precision.FLOAT.
+MANIFEST = "manifest.json"
+FORMAT_VERSION = 1
+
+
+def is_store(path):
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+def write_manifest(path, manifest):
+    tmp = os.path.join(path, MANIFEST + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, os.path.join(path, MANIFEST))
+
+
+def save_arrays(arrays, path, **meta):
+    """
+    Writes an ordered mapping of variable name to (num_samples, *shape)
+    array as a trace store. Extra keyword arguments are kept in the manifest.
+    """
+    os.makedirs(path, exist_ok=True)
+    variables = []
+    num_samples = None
+    for name, values in arrays.items():
+        values = np.asarray(values)
+        values = values.astype(precision.storage_dtype(values.dtype), copy=False)
+        if num_samples is None:
+            num_samples = len(values)
+        elif len(values) != num_samples:
+            raise ValueError("Variable %s has %d samples, expected %d"
+                             % (name, len(values), num_samples))
+        fname = name + ".npy"
+        np.save(os.path.join(path, fname), values)
+        variables.append({"name": name, "file": fname,
+                          "shape": list(values.shape[1:]), "dtype": str(values.dtype)})
+    manifest = dict(meta, format=FORMAT_VERSION, num_samples=num_samples or 0,
+                    variables=variables)
+    # The manifest goes last, a store without one is incomplete
+    write_manifest(path, manifest)
+    return manifest
+
+
+class StoreWriter:
+    def __init__(self, path, variables, num_samples, **meta):
+        """
+        Preallocates a trace store on disk and exposes each variable as a
+        writable memory-mapped (num_samples, *shape) array, so samples can be
+        written incrementally without holding them in memory. The manifest is
+        written by flush/close and records how many samples are valid.
+
+        Args:
+        - path: Directory to write
+        - variables: Ordered mapping of name to (shape, dtype)
+        - num_samples: Capacity in samples
+        - meta: Extra manifest entries
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.meta = meta
+        self.arrays = OrderedDict()
+        self.variables = []
+        for name, (shape, dtype) in variables.items():
+            dtype = precision.storage_dtype(dtype)
+            fname = name + ".npy"
+            self.arrays[name] = np.lib.format.open_memmap(
+                os.path.join(path, fname), mode="w+", dtype=dtype,
+                shape=(num_samples,) + tuple(shape))
+            self.variables.append({"name": name, "file": fname, "shape": list(shape),
+                                   "dtype": str(np.dtype(dtype))})
+
+    def flush(self, num_samples):
+        for arr in self.arrays.values():
+            arr.flush()
+        write_manifest(self.path, dict(self.meta, format=FORMAT_VERSION,
+                                       num_samples=int(num_samples),
+                                       variables=self.variables))
+
+    def close(self, num_samples):
+        self.flush(num_samples)
+        self.arrays = OrderedDict()
+
+
+def save(trace, path, varnames=None):
+    """
+    Saves a pymc3 MultiTrace as a trace store, concatenating its chains.
+
+    Args:
+    - trace: pymc3 MultiTrace
+    - path: Directory to write
+    - varnames: Variables to keep (default: trace.varnames, in model order)
+    """
+    varnames = varnames or trace.varnames
+    chains = trace.chains
+    # Copied one chain of one variable at a time, so traces streamed to disk
+    # (streamtrace.py) are never fully loaded
+    lengths = [len(trace.get_values(varnames[0], chains=[c])) for c in chains]
+    variables = OrderedDict()
+    for name in varnames:
+        first = trace.get_values(name, chains=[chains[0]])
+        variables[name] = (first.shape[1:], first.dtype)
+    writer = StoreWriter(path, variables, sum(lengths), chains=trace.nchains)
+    for name in varnames:
+        pos = 0
+        for c, n in zip(chains, lengths):
+            writer.arrays[name][pos:pos+n] = trace.get_values(name, chains=[c])
+            pos += n
+    writer.close(sum(lengths))
+
+
+class TraceStore:
+    def __init__(self, path, mmap_mode="r"):
+        """
+        Read access to a trace store written by save/save_arrays. Exposes
+        the parts of the MultiTrace interface used in this repo (varnames,
+        len, point, get_values).
+
+        Args:
+        - path: Trace store directory
+        - mmap_mode: Passed to np.load (default "r", None reads into memory)
+        """
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.varnames = [v["name"] for v in self.manifest["variables"]]
+        self.num_samples = self.manifest["num_samples"]
+        self.mmap_mode = mmap_mode
+        self._arrays = {}
+
+    def __len__(self):
+        return self.num_samples
+
+    def array(self, name):
+        """ The full (num_samples, *shape) array of a variable, memory-mapped. """
+        if name not in self._arrays:
+            entry = self.manifest["variables"][self.varnames.index(name)]
+            self._arrays[name] = np.load(os.path.join(self.path, entry["file"]),
+                                         mmap_mode=self.mmap_mode)
+        return self._arrays[name]
+
+    def get_values(self, name, combine=True, idx=None):
+        values = self.array(name)[:self.num_samples]
+        return precision.compute(values if idx is None else values[idx])
+
+    def check_index(self, ids):
+        """
+        Sample indices with negative ones counted from num_samples. Rows
+        past num_samples are preallocated but not (yet) written, e.g. in an
+        interrupted streamed run, so indexing them raises IndexError.
+        """
+        ids = np.asarray(ids)
+        ids = np.where(ids < 0, ids + self.num_samples, ids)
+        bad = (ids < 0) | (ids >= self.num_samples)
+        if np.any(bad):
+            raise IndexError("sample %s out of range for a store of %d samples"
+                             % (np.asarray(ids)[bad].ravel()[0], self.num_samples))
+        return ids
+
+    def point(self, i):
+        i = int(self.check_index(int(i)))
+        return OrderedDict((name, np.array(precision.compute(self.array(name)[i])))
+                           for name in self.varnames)
+
+    def select(self, ids):
+        """ Stacked (len(ids), *shape) weights for the given sample indices. """
+        ids = self.check_index(ids)
+        return OrderedDict((name, precision.compute(self.array(name)[ids]))
+                           for name in self.varnames)
+
+
+def load(path, mmap_mode="r"):
+    return TraceStore(path, mmap_mode=mmap_mode)